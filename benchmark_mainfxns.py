@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Benchmarks for the functions in module_mainfxns.
+
+The datasets are synthetic and seedable: counts are drawn from cluster
+specific expression profiles so that the Leiden partition stored in
+adata.obs['leiden'] is realistic (imbalanced cluster sizes, clusters named
+'0', '1', ... from largest to smallest, as scanpy does). Every function is
+timed on a fresh copy of its input and, in a separate run, memory profiled
+with tracemalloc. Results are appended to a JSON-lines history file so runs
+can be compared against each other and used to gate releases. Every
+dataset also goes through consistency_checks (results that must not depend
+on the number of workers, the memory budget or the precision); a failed
+check makes the exit status 1.
+
+Example:
+
+    python benchmark_mainfxns.py --cells 10000 100000 --layout sparse dense
+    python benchmark_mainfxns.py --cells 10000 --compare --max-regression 1.25
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import anndata as ad
+
+import module_mainfxns as mf
+
+SIZES = {'10k': 10000, '100k': 100000, '1M': 1000000}
+HISTORY = os.path.join('benchmarks', 'history.jsonl')
+
+
+def synthetic_counts(n_cells, n_genes=2000, n_clusters=20, sparse=True, seed=0,
+                     block=10000):
+    '''Returns a synthetic raw count AnnData object with a Leiden partition.
+
+    Input:
+    n_cells : number of cells
+    n_genes : number of genes, the pathway genes of module_mainfxns are
+              always included
+    n_clusters : number of Leiden clusters
+    sparse : whether X is a CSR matrix or a dense array
+    seed : seed of the random generator, the same seed gives the same data
+    block : number of cells generated at a time, bounds the memory used
+
+    Output:
+    AnnData object with float32 counts, obs['leiden'] and the QC columns
+    used by the module ('n_genes_per_cell', 'n_total_counts_per_cell')
+    '''
+    rng = np.random.default_rng(seed)
+    pathway = list(dict.fromkeys(mf.wnts + mf.wntr + mf.bmps + mf.bmpr + mf.notch))
+    genes = pathway + ['Gene' + str(i) for i in range(max(n_genes - len(pathway), 0))]
+    n_genes = len(genes)
+
+    # Imbalanced cluster sizes, largest cluster first like sc.tl.leiden
+    sizes = np.sort(rng.dirichlet(np.full(n_clusters, 0.7)))[::-1]
+    labels = rng.choice(n_clusters, size=n_cells, p=sizes)
+    # Cluster profiles: a shared gamma baseline with cluster specific up/down
+    # regulation, most genes are lowly expressed which makes X ~90% sparse
+    base = rng.gamma(0.3, 0.4, size=n_genes)
+    profiles = base * rng.lognormal(0, 1, size=(n_clusters, n_genes))
+    size_factors = rng.lognormal(np.log(1.0), 0.4, size=n_cells)
+
+    blocks = []
+    for start in range(0, n_cells, block):
+        stop = min(start + block, n_cells)
+        mean = profiles[labels[start:stop]] * size_factors[start:stop, None]
+        counts = rng.poisson(mean).astype(np.float32)
+        blocks.append(sp.csr_matrix(counts) if sparse else counts)
+    X = sp.vstack(blocks, format='csr') if sparse else np.vstack(blocks)
+
+    obs = pd.DataFrame(index=['cell' + str(i) for i in range(n_cells)])
+    obs['leiden'] = pd.Categorical([str(i) for i in labels],
+                                   categories=[str(i) for i in range(n_clusters)])
+    adata = ad.AnnData(X=X, obs=obs, var=pd.DataFrame(index=genes))
+    nnz = (X > 0).sum(1)
+    adata.obs['n_genes_per_cell'] = np.asarray(nnz).ravel()
+    adata.obs['n_total_counts_per_cell'] = np.asarray(X.sum(1)).ravel()
+    return adata
+
+
+def prepared_data(raw):
+    '''Runs the preprocessing pipeline on a copy of raw so that the
+    downstream functions get the inputs they expect.
+
+    Output:
+    dictionary with the 'normalized', 'merged' and 'scaled' AnnData objects
+    '''
+    norm = mf.normalize_data(raw.copy(), 1e4)
+    merged = mf.merge_genes(norm, [mf.wnts, mf.wntr, mf.bmps, mf.bmpr, mf.notch]).copy()
+    scaled = mf.scale_data(merged.copy())
+    return {'normalized': norm, 'merged': merged, 'scaled': scaled}
+
+
+def benchmark_cases(raw, prepared, markers):
+    '''Yields (name, setup, fn) tuples. setup builds a fresh input outside
+    of the timed region, fn(input) runs the benchmarked call.'''
+    scaled = prepared['scaled']
+    merged = prepared['merged']
+    X = mf.gene_expression(scaled.copy(), mf.wntr).T.values
+
+    yield 'filter_data', raw.copy, lambda a: mf.filter_data(a, min_counts=10, min_genes=10)
+    yield 'normalize_data', raw.copy, lambda a: mf.normalize_data(a, 1e4)
+    yield ('merge_genes', prepared['normalized'].copy,
+           lambda a: mf.merge_genes(a, [mf.wnts, mf.wntr, mf.bmps, mf.bmpr, mf.notch]))
+    yield 'select_genes', prepared['normalized'].copy, mf.select_genes
+    yield 'scale_data', merged.copy, mf.scale_data
+    yield 'scale_data_chunked', merged.copy, lambda a: mf.scale_data_chunked(a, max_memory=2**28)
+    yield 'gene_expression', scaled.copy, lambda a: mf.gene_expression(a, mf.wntr)
+    yield 'gene_expression_norm', scaled.copy, lambda a: mf.gene_expression_norm(a, mf.wntr)
+    yield ('marker_gene_expression', scaled.copy,
+           lambda a: mf.marker_gene_expression(a, markers))
+    yield 'evaluate_partition', scaled.copy, lambda a: mf.evaluate_partition(a, markers)
+    yield 'silhouette_analysis', lambda: X, lambda x: mf.silhouette_analysis(range(2, 6), x)
+    yield 'heatmap', scaled.copy, lambda a: mf.heatmap(a, mf.wntr, 4, 'wntr_clusters')
+
+
+def scaling_error(prepared):
+    '''Maximum absolute and relative (to the largest value) difference
+    between scale_data_chunked and the reference scale_data output. The
+    reference is computed with chunked=False, since in float32 mode
+    prepared['scaled'] itself comes from scale_data_chunked.'''
+    reference = mf.scale_data(prepared['merged'].copy(), chunked=False).X
+    reference = np.asarray(reference, dtype=np.float64)
+    chunked = mf.scale_data_chunked(prepared['merged'].copy(), max_memory=2**28).X
+    error = np.abs(np.asarray(chunked, dtype=np.float64) - reference).max()
+    return error, error / np.abs(reference).max()
+
+
+def precision_drift(raw, markers):
+    '''Largest difference, relative to the largest value, between the
+    float32 and the float64 pipeline for the expression summaries.'''
+    results = {}
+    for precision in ('float64', 'float32'):
+        mf.set_precision(precision)
+        scaled = prepared_data(raw)['scaled']
+        results[precision] = [mf.gene_expression(scaled.copy(), mf.wntr, n_jobs=1),
+                              mf.gene_expression_norm(scaled.copy(), mf.wntr, n_jobs=1),
+                              mf.evaluate_partition(scaled.copy(), markers, n_jobs=1)]
+    drift = 0.0
+    for ref, low in zip(results['float64'], results['float32']):
+        ref = ref.values.astype(float)
+        low = low.values.astype(float)
+        drift = max(drift, np.nanmax(np.abs(ref - low)) / max(np.nanmax(np.abs(ref)), 1e-12))
+    return drift
+
+
+def consistency_checks(raw, prepared, markers):
+    '''Checks of properties the module promises, independent of timing.
+    Returns the names of the failed checks.'''
+    failed = []
+    n_cells, n_genes = prepared['scaled'].shape
+
+    # A memory budget may only shrink the blocks of the chunked summaries,
+    # a large one must not leave workers idle
+    blocks = -(-n_cells // mf._cluster_chunk(4, n_genes))
+    with mf.resource_limits(memory=8e9):
+        budget_blocks = -(-n_cells // mf._cluster_chunk(4, n_genes))
+    if budget_blocks < blocks:
+        failed.append('chunked blocks with a memory budget')
+
+    # The permutation p-values do not depend on the workers or the budget
+    scaled = prepared['scaled']
+    pvalues = [mf.permutation_test(scaled, mf.wntr, n_permutations=50, n_jobs=1)[1]]
+    pvalues.append(mf.permutation_test(scaled, mf.wntr, n_permutations=50, n_jobs=3)[1])
+    with mf.resource_limits(memory=1e6):
+        pvalues.append(mf.permutation_test(scaled, mf.wntr, n_permutations=50, n_jobs=3)[1])
+    if not all(p.equals(pvalues[0]) for p in pvalues[1:]):
+        failed.append('permutation_test p-values across n_jobs and budgets')
+
+    # float32 per-cluster sums stay close to the float64 ones however many
+    # cells one block holds (sums over many cells are accumulated in float64)
+    merged = prepared['merged']
+    codes = merged.obs['leiden'].cat.codes.values.astype(np.int64)
+    n_clusters = len(merged.obs['leiden'].cat.categories)
+    sums64 = mf._partial_sums(merged.X.astype(np.float64), codes, n_clusters, False)[0]
+    sums32 = mf._partial_sums(merged.X.astype(np.float32), codes, n_clusters, False)[0]
+    if np.abs(sums32 - sums64).max() > 1e-5 * np.abs(sums64).max():
+        failed.append('float32 per-cluster sums')
+
+    for name in failed:
+        print('check failed: ' + name)
+    return failed
+
+
+def run_case(setup, fn, repeats):
+    '''Returns the best wall time over repeats and the tracemalloc peak
+    (in MB) of one additional run.'''
+    times = []
+    for _ in range(repeats):
+        data = setup()
+        mf.clear_linkage_cache()
+        start = time.perf_counter()
+        fn(data)
+        times.append(time.perf_counter() - start)
+        plt.close('all')
+        del data
+    data = setup()
+    mf.clear_linkage_cache()
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    plt.close('all')
+    return min(times), peak / 2**20
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(records, history, max_regression):
+    '''Compares each record with the latest record of the same benchmark
+    from a previous run. Returns the list of regressions above
+    max_regression (ratio of new to old time).'''
+    latest = {}
+    for rec in history:
+        latest[rec_key(rec)] = rec
+    regressions = []
+    print('\n%-24s %8s %7s %10s %10s %7s' % ('function', 'cells', 'layout', 'old (s)', 'new (s)', 'ratio'))
+    for rec in records:
+        old = latest.get(rec_key(rec))
+        if old is None:
+            continue
+        ratio = rec['seconds'] / old['seconds'] if old['seconds'] > 0 else float('inf')
+        print('%-24s %8d %7s %10.4f %10.4f %7.2f' % (rec['function'], rec['n_cells'], rec['layout'],
+                                                     old['seconds'], rec['seconds'], ratio))
+        if max_regression is not None and ratio > max_regression:
+            regressions.append((rec, old, ratio))
+    return regressions
+
+
+def rec_key(rec):
+    return (rec['function'], rec['n_cells'], rec['n_genes'], rec['layout'],
+            rec.get('precision', 'float64'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--cells', nargs='+', default=['10k'],
+                        help='dataset sizes, e.g. 10k 100k 1M or a number of cells')
+    parser.add_argument('--genes', type=int, default=2000)
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--layout', nargs='+', default=['sparse'], choices=['sparse', 'dense'])
+    parser.add_argument('--precision', nargs='+', default=['float64'], choices=['float64', 'float32'],
+                        help='precision(s) of the data, see module_mainfxns.set_precision')
+    parser.add_argument('--max-drift', type=float, default=1e-3,
+                        help='with both precisions, exit with status 1 if the float32 results '
+                             'differ from the float64 ones by more than this (relative)')
+    parser.add_argument('--max-scaling-error', type=float, default=1e-5,
+                        help='exit with status 1 if scale_data_chunked differs from scale_data by '
+                             'more than this (relative to the largest value)')
+    parser.add_argument('--functions', nargs='+', default=None,
+                        help='only run these functions (default: all)')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--history', default=HISTORY)
+    parser.add_argument('--compare', action='store_true',
+                        help='compare with the latest previous run in the history')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='exit with status 1 if a function is slower by more than this ratio')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args(argv)
+
+    history = load_history(args.history)
+    run_id = datetime.datetime.now().isoformat(timespec='seconds')
+    meta = {'run': run_id, 'git': git_revision(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'scanpy': mf.sc.__version__, 'host': platform.node()}
+    markers = {'wnt': mf.wnts, 'wnt_receptor': mf.wntr, 'bmp': mf.bmps,
+               'bmp_receptor': mf.bmpr, 'notch': mf.notch}
+
+    records = []
+    drifted = []
+    failed_checks = []
+    scaling_failures = []
+    for size in args.cells:
+        n_cells = SIZES.get(size) or int(size)
+        for layout in args.layout:
+            raw = synthetic_counts(n_cells, args.genes, args.clusters,
+                                   sparse=(layout == 'sparse'), seed=args.seed)
+            if len(args.precision) > 1:
+                drift = precision_drift(raw, markers)
+                print('float32 drift: %.3g (relative)' % drift)
+                if drift > args.max_drift:
+                    drifted.append((n_cells, layout, drift))
+            for precision in args.precision:
+                mf.set_precision(precision)
+                prepared = prepared_data(raw)
+                abs_error, rel_error = scaling_error(prepared)
+                print('scale_data_chunked max error: %.3g (relative %.3g)' % (abs_error, rel_error))
+                if rel_error > args.max_scaling_error:
+                    scaling_failures.append((n_cells, layout, precision, rel_error))
+                failed_checks += consistency_checks(raw, prepared, markers)
+                for name, setup, fn in benchmark_cases(raw, prepared, markers):
+                    if args.functions and name not in args.functions:
+                        continue
+                    seconds, peak_mb = run_case(setup, fn, args.repeats)
+                    rec = dict(meta, function=name, n_cells=n_cells, n_genes=raw.n_vars,
+                               n_clusters=args.clusters, layout=layout, precision=precision,
+                               seed=args.seed, seconds=seconds, peak_mb=peak_mb)
+                    if name == 'scale_data_chunked':
+                        rec['max_abs_error'] = abs_error
+                    records.append(rec)
+                    print('%-24s %8d %7s %7s %10.4f s %10.1f MB' % (name, n_cells, layout, precision,
+                                                                    seconds, peak_mb))
+                del prepared
+            del raw
+    mf.set_precision('float64')
+
+    regressions = compare(records, history, args.max_regression) if args.compare else []
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(args.history) or '.', exist_ok=True)
+        with open(args.history, 'a') as f:
+            for rec in records:
+                f.write(json.dumps(rec) + '\n')
+
+    status = 0
+    if regressions:
+        print('\n%d benchmark(s) regressed by more than %.2fx' % (len(regressions), args.max_regression))
+        status = 1
+    if drifted:
+        print('\nfloat32 results drifted by more than %.3g for %d dataset(s)' % (args.max_drift, len(drifted)))
+        status = 1
+    if scaling_failures:
+        print('\nscale_data_chunked differs from scale_data by more than %.3g for %d dataset(s)'
+              % (args.max_scaling_error, len(scaling_failures)))
+        status = 1
+    if failed_checks:
+        print('\n%d consistency check(s) failed' % len(failed_checks))
+        status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,16 +6,83 @@
 
 import numpy as np
 import pandas as pd
-import scanpy as sc
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib.lines import Line2D
-from matplotlib import cm, colors
-import scipy.cluster.hierarchy as sch
-import seaborn as sns
+import scipy.sparse as sp
+import collections
+import contextlib
 import datetime
-from sklearn.metrics import silhouette_samples, silhouette_score
-from sklearn.cluster import KMeans
+import functools
+import hashlib
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import weakref
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# scanpy, matplotlib, seaborn, scipy.cluster.hierarchy and scikit-learn take
+# several seconds to import. They are only imported the first time one of
+# the functions that needs them is called, so that compute-only jobs (e.g.
+# gene_expression) start quickly. Modules are bound to _LazyModule proxies
+# below; single classes and functions (KMeans, Line2D, ...) are imported
+# inside the functions that use them.
+
+class _LazyModule(object):
+    '''Stands in for a module and imports it on first attribute access.'''
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self.__dict__['_module'] is None:
+            self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+        return self.__dict__['_module']
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return '<lazy module %r (%s)>' % (self.__dict__['_name'], state)
+
+sc = _LazyModule('scanpy')
+plt = _LazyModule('matplotlib.pyplot')
+sch = _LazyModule('scipy.cluster.hierarchy')
+sns = _LazyModule('seaborn')
+ad = _LazyModule('anndata')
+cm = _LazyModule('matplotlib.cm')
+colors = _LazyModule('matplotlib.colors')
+
+# Backward compatibility only: names that used to be imported at module level
+# and that scripts may still take from this module (module_mainfxns.KMeans).
+# They are resolved on first access through the module __getattr__ below and
+# are not used by the code of this module.
+_lazy_names = {'PdfPages': ('matplotlib.backends.backend_pdf', 'PdfPages'),
+               'Line2D': ('matplotlib.lines', 'Line2D'),
+               'silhouette_samples': ('sklearn.metrics', 'silhouette_samples'),
+               'silhouette_score': ('sklearn.metrics', 'silhouette_score'),
+               'KMeans': ('sklearn.cluster', 'KMeans')}
+
+def __getattr__(name):
+    if name in _lazy_names:
+        module, attr = _lazy_names[name]
+        value = getattr(importlib.import_module(module), attr)
+        globals()[name] = value
+        return value
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 # Here are the lists of genes for our main pathways of interest.
 
@@ -36,7 +103,292 @@ bmpr = ["Bmpr1a" ,"Bmpr1b" ,"Acvr1"  ,"Acvrl1" ,"Acvr1b" ,"Tgfbr1" , "Acvr1c",
 notch = ["Dll1", "Dll3","Dll4", "Jag1", "Jag2", "Notch1", "Notch2", 
              "Notch3", "Notch4", "Mfng", "Rfng", "Lfng"]
 
+# The pathways by the names used in the figures.
+
+pathways = {'Wnt Ligands': wnts, 'Wnt Receptors': wntr, 'BMP Ligands': bmps,
+            'BMP Receptors': bmpr, 'Notch': notch}
+
+
+# Opt-in profiling of the analysis functions. When profiling is disabled the
+# decorated functions only pay for one flag check, and _stage returns a shared
+# no-op context manager.
+
+_profiling = {'enabled': False, 'memory': False, 'records': [], 'origin': 0.0}
+_profiling_lock = threading.Lock()
+_profiling_local = threading.local()
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_null_stage = _NullStage()
+
+class _Stage(object):
+    '''Times one function call or one internal stage of a call.'''
+    def __init__(self, name, sizes=None):
+        self.name = name
+        self.sizes = sizes or {}
+
+    def __enter__(self):
+        stack = getattr(_profiling_local, 'stack', None)
+        if stack is None:
+            stack = _profiling_local.stack = []
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        self.mem_start = None
+        if _profiling['memory'] and tracemalloc.is_tracing():
+            # The tracemalloc peak is reset for every stage. The peak reached
+            # so far by the enclosing stage is kept in its peak_seen, so both
+            # are measured from their own start.
+            current, peak = tracemalloc.get_traced_memory()
+            if hasattr(tracemalloc, 'reset_peak'):
+                if stack and stack[-1].mem_start is not None:
+                    stack[-1].peak_seen = max(stack[-1].peak_seen, peak)
+                tracemalloc.reset_peak()
+                self.mem_start = self.peak_seen = current
+            elif not stack:
+                # Without reset_peak only top-level calls get a peak
+                self.mem_start = self.peak_seen = current
+        stack.append(self)
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        record = {'name': self.name, 'parent': self.parent, 'depth': self.depth,
+                  'start': self.wall_start - _profiling['origin'],
+                  'wall': wall, 'cpu': cpu, 'thread': threading.get_ident(),
+                  'pid': os.getpid()}
+        _profiling_local.stack.pop()
+        if self.mem_start is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, self.peak_seen)
+            record['mem_delta'] = current - self.mem_start
+            record['peak_mem_delta'] = peak - self.mem_start
+            stack = _profiling_local.stack
+            if stack and stack[-1].mem_start is not None:
+                stack[-1].peak_seen = max(stack[-1].peak_seen, peak)
+        if _resources['memory'] is not None or _resources['workers'] is not None:
+            # The limits in effect while the stage ran (see resource_report)
+            record['memory_budget'] = _resources['memory']
+            record['max_workers'] = _max_workers()
+        record.update(self.sizes)
+        with _profiling_lock:
+            _profiling['records'].append(record)
+        return False
+
+def _input_sizes(args):
+    '''Cells, genes and clusters of the first AnnData object or DataFrame
+    among args.'''
+    for a in args:
+        if hasattr(a, 'n_obs') and hasattr(a, 'n_vars'):
+            sizes = {'cells': a.n_obs, 'genes': a.n_vars}
+            if 'leiden' in a.obs.columns and hasattr(a.obs['leiden'], 'cat'):
+                sizes['clusters'] = len(a.obs['leiden'].cat.categories)
+            return sizes
+        if isinstance(a, pd.DataFrame):
+            return {'genes': a.shape[0], 'clusters': a.shape[1]}
+        if isinstance(a, np.ndarray) and a.ndim == 2:
+            return {'rows': a.shape[0], 'cols': a.shape[1]}
+    return {}
+
+def _profiled(fn):
+    '''Decorator recording every call of fn while profiling is enabled.'''
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _profiling['enabled']:
+            return fn(*args, **kwargs)
+        with _Stage(fn.__name__, _input_sizes(args)):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def _stage(name):
+    '''Context manager timing an internal stage of a profiled function.'''
+    if not _profiling['enabled']:
+        return _null_stage
+    return _Stage(name)
+
+def enable_profiling(memory = False):
+    '''Starts recording wall time, CPU time and input sizes of every call
+    (and internal stage) of the analysis functions. With memory=True the
+    memory delta and peak memory delta are also recorded using tracemalloc,
+    which slows down the calls.'''
+    _profiling['memory'] = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if not _profiling['records']:
+        _profiling['origin'] = time.perf_counter()
+    _profiling['enabled'] = True
+
+def disable_profiling():
+    '''Stops recording. The records collected so far are kept.'''
+    _profiling['enabled'] = False
+    if _profiling['memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _profiling['memory'] = False
+
+def profiling_records(clear = False):
+    '''Returns the profiling records as a DataFrame, one row per call or
+    stage. If clear is True the records are discarded afterwards.'''
+    with _profiling_lock:
+        df = pd.DataFrame(_profiling['records'])
+        if clear:
+            _profiling['records'] = []
+    return df
+
+def write_profile(path, format = 'chrome'):
+    '''Writes the profiling records to path.
+    
+    format : 'chrome' writes a Chrome trace (open it in chrome://tracing or
+    Perfetto), 'jsonl' writes one JSON record per line.
+    '''
+    with _profiling_lock:
+        records = list(_profiling['records'])
+    with open(path, 'w') as f:
+        if format == 'jsonl':
+            for r in records:
+                f.write(json.dumps(r, default=str) + '\n')
+        elif format == 'chrome':
+            events = []
+            for r in records:
+                args = {k: v for k, v in r.items()
+                        if k not in ('name', 'start', 'wall', 'pid', 'thread', 'parent', 'depth')}
+                events.append({'name': r['name'], 'ph': 'X', 'cat': r['parent'] or 'call',
+                               'ts': r['start'] * 1e6, 'dur': r['wall'] * 1e6,
+                               'pid': r['pid'], 'tid': r['thread'], 'args': args})
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+        else:
+            raise ValueError("format should be 'chrome' or 'jsonl'")
+
+
+# Precision of the data. In float32 mode normalize_data and scale_data keep
+# the expression matrix in float32 (half the memory and bandwidth of
+# float64) and the expression summaries read it without upcasting it; sums
+# over many cells are still accumulated in float64.
+
+_precision = {'dtype': np.float64}
+
+def set_precision(precision):
+    '''Sets the precision of the data, 'float32' or 'float64' (the default).'''
+    dtype = np.dtype(precision)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("precision should be 'float32' or 'float64'")
+    _precision['dtype'] = dtype.type
+
+def get_precision():
+    return _precision['dtype']
+
+def _as_precision(X):
+    '''X cast to the precision of the module if it is float32 mode (no copy
+    if it already has that dtype).'''
+    if _precision['dtype'] is np.float32 and X.dtype != np.float32:
+        return X.astype(np.float32)
+    return X
+
+# Resource limits of the whole module: a memory budget, a maximum number of
+# workers and a spill directory. Chunk sizes (scaling, aggregation, parsing,
+# permutation blocks), pool sizes (chunked backend, batch mode, permutations,
+# silhouette analysis, consensus clustering) and spilling of large outputs to disk are derived
+# from them. With report=True the memory and workers actually used by every
+# call are recorded and compared to the budget (see resource_report).
+
+_resources = {'memory': None, 'workers': None, 'spill_dir': None}
+
+def set_resource_limits(memory = None, workers = None, spill_dir = None):
+    '''Sets the resource limits of the module.
+    
+    Input:
+    memory : memory budget in bytes (None for no budget)
+    workers : maximum number of worker threads/processes (None for all cores)
+    spill_dir : directory for outputs that do not fit in the memory budget,
+                the system temporary directory by default
+    '''
+    _resources.update(memory=memory, workers=workers, spill_dir=spill_dir)
+
+@contextlib.contextmanager
+def resource_limits(memory = None, workers = None, spill_dir = None, report = False):
+    '''Context manager version of set_resource_limits, the previous limits
+    are restored on exit. With report=True memory profiling is enabled inside
+    the block, see resource_report.'''
+    previous = dict(_resources)
+    profiling = (_profiling['enabled'], _profiling['memory'])
+    set_resource_limits(memory, workers, spill_dir)
+    report = report and profiling != (True, True)
+    if report:
+        enable_profiling(memory=True)
+    try:
+        yield _resources
+    finally:
+        # Profiling is left as the caller had it
+        if report and profiling[0]:
+            _profiling['memory'] = False
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+        elif report:
+            disable_profiling()
+        _resources.update(previous)
+
+def _max_workers(requested = None):
+    '''The number of workers to use: requested (all cores by default),
+    capped by the worker limit.'''
+    n = requested or os.cpu_count() or 1
+    if _resources['workers']:
+        n = min(n, _resources['workers'])
+    return max(1, int(n))
+
+def _memory_budget(default, fraction = 1.0):
+    '''A fraction of the memory budget, or default if there is none.'''
+    if _resources['memory'] is None:
+        return default
+    return max(1, int(_resources['memory'] * fraction))
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _spill(shape, dtype, prefix):
+    '''A memory-mapped .npy array in the spill directory. The file is deleted
+    once the array (and every view of it) is garbage collected, or at exit.'''
+    fd, path = tempfile.mkstemp(suffix='.npy', prefix=prefix, dir=_resources['spill_dir'])
+    os.close(fd)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    weakref.finalize(out, _remove_file, path)
+    return out
+
+def _note(key, value):
+    '''Records value (e.g. the number of workers) on the current profiling
+    stage and its parents, keeping the maximum.'''
+    if not _profiling['enabled']:
+        return
+    for stage in getattr(_profiling_local, 'stack', None) or ():
+        stage.sizes[key] = max(stage.sizes.get(key, value), value)
 
+def resource_report(clear = False):
+    '''Per call and stage recorded inside resource_limits(report=True): the
+    wall time, peak memory, workers used, and the memory budget and worker
+    limit in effect when it ran, with the fraction of the budget actually
+    used.'''
+    df = profiling_records(clear)
+    if df.empty:
+        return df
+    for column in ('workers', 'memory_budget', 'max_workers'):
+        if column not in df:
+            df[column] = np.nan
+    if 'peak_mem_delta' in df:
+        budget = pd.to_numeric(df['memory_budget'], errors='coerce')
+        df['memory_used_fraction'] = df['peak_mem_delta'] / budget.where(budget > 0)
+    columns = [c for c in ['name', 'parent', 'depth', 'wall', 'cpu', 'peak_mem_delta', 'memory_budget',
+                           'memory_used_fraction', 'workers', 'max_workers', 'cells', 'genes', 'clusters']
+               if c in df]
+    return df[columns]
+
+@_profiled
 def get_genes(adata, genes):
     '''This function gets genes of interest that have not been filtered out.
     Input: 
@@ -54,6 +406,7 @@ def get_genes(adata, genes):
             list_genes.append(i)
     return list_genes
 
+@_profiled
 def vis_pre_processing(adata, genes_range = (0,10000), counts_range = (0, 400000), title=""):
     '''A histogram of genes/cell and counts/cell, a boxplot of 15 highest
     expressed genes, a scatterplot of genes against counts, finally violin
@@ -75,7 +428,8 @@ def vis_pre_processing(adata, genes_range = (0,10000), counts_range = (0, 400000
     ax[0,1].set_ylabel('Frequency')
     ax[0,1].set_xscale('log')
     
-    sc.pl.highest_expr_genes(adata, n_top=15, ax=ax[1,0], show=False)
+    with _stage('highest_expr_genes'):
+        sc.pl.highest_expr_genes(adata, n_top=15, ax=ax[1,0], show=False)
     ax[1,0].set_title('15 Highest Expressed Genes')
     sc.pl.scatter(adata, x='n_total_counts_per_cell', y='n_genes', size = 20, 
                   title = 'Counts vs. Genes', ax=ax[1,1], show=False)
@@ -86,12 +440,16 @@ def vis_pre_processing(adata, genes_range = (0,10000), counts_range = (0, 400000
     plt.show()
     return fig
 
+@_profiled
 def filter_data(adata, min_counts=2000, min_genes=2000, min_cells=3):
-    sc.pp.filter_cells(adata, min_counts=min_counts)
-    sc.pp.filter_cells(adata, min_genes=min_genes)
-    sc.pp.filter_genes(adata, min_cells=min_cells)
+    with _stage('filter_cells'):
+        sc.pp.filter_cells(adata, min_counts=min_counts)
+        sc.pp.filter_cells(adata, min_genes=min_genes)
+    with _stage('filter_genes'):
+        sc.pp.filter_genes(adata, min_cells=min_cells)
     return adata
 
+@_profiled
 def vis_post_processing(adata, genes_range = (0,10000), counts_range = (0, 400000),title=""):
     '''Histograms of genes and total counts, and finally a scatter plot
     of genes against counts.
@@ -121,7 +479,119 @@ def vis_post_processing(adata, genes_range = (0,10000), counts_range = (0, 40000
     plt.show()
     return fig
 
-def normalize_data(adata,count,**kwargs):
+def _column_moments(X, transform = None, chunk_size = None):
+    '''Column means and unbiased variances of X (cells x genes), accumulated
+    in float64 in one pass over the nonzero values of a sparse X (or over
+    row blocks of a dense X). Neither the matrix nor a transformed copy of it
+    is materialized.
+    
+    transform : optional elementwise function applied to the values first,
+                it has to map 0 to 0 (e.g. np.expm1)
+    chunk_size : number of values processed at a time, derived from the
+                 memory budget by default
+    '''
+    n, m = X.shape
+    if chunk_size is None:
+        chunk_size = _memory_budget(32 << 22, 0.25) // 32
+    total = np.zeros(m)
+    total_sq = np.zeros(m)
+    if sp.issparse(X):
+        if sp.isspmatrix_csc(X):
+            columns = np.repeat(np.arange(m), np.diff(X.indptr))
+        else:
+            X = X.tocsr()
+            columns = X.indices
+        for start in range(0, X.nnz, chunk_size):
+            values = X.data[start:start + chunk_size].astype(np.float64)
+            if transform is not None:
+                values = transform(values)
+            cols = columns[start:start + chunk_size]
+            total += np.bincount(cols, weights=values, minlength=m)
+            total_sq += np.bincount(cols, weights=values * values, minlength=m)
+    else:
+        rows = max(1, chunk_size // max(m, 1))
+        for start in range(0, n, rows):
+            block = np.asarray(X[start:start + rows], dtype=np.float64)
+            if transform is not None:
+                block = transform(block)
+            total += block.sum(0)
+            total_sq += np.einsum('ij,ij->j', block, block)
+    mean = total / n
+    var = (total_sq - n * mean**2) / max(n - 1, 1)
+    return mean, np.maximum(var, 0)
+
+@_profiled
+def highly_variable_genes(adata, min_mean=0.0125, max_mean=3, min_disp=0.5, max_disp=np.inf, n_bins=20):
+    '''Annotates highly variable genes of log-transformed data like
+    sc.pp.highly_variable_genes (flavor 'seurat'), but computes the
+    dispersion statistics in one pass over the nonzero values without
+    copying or densifying the matrix.
+    
+    Sets adata.var['highly_variable'], ['means'], ['dispersions'] and
+    ['dispersions_norm'].
+    '''
+    mean, var = _column_moments(adata.X, transform=np.expm1)
+    mean[mean == 0] = 1e-12
+    dispersion = var / mean
+    dispersion[dispersion == 0] = np.nan
+    dispersion = np.log(dispersion)
+    mean = np.log1p(mean)
+
+    df = pd.DataFrame({'means': mean, 'dispersions': dispersion})
+    df['mean_bin'] = pd.cut(df['means'], bins=n_bins)
+    disp_grouped = df.groupby('mean_bin')['dispersions']
+    disp_mean_bin = disp_grouped.mean()
+    disp_std_bin = disp_grouped.std(ddof=1)
+    # Bins with a single gene get a normalized dispersion of 1, as in scanpy
+    one_gene_per_bin = disp_std_bin.isnull()
+    disp_std_bin[one_gene_per_bin.values] = disp_mean_bin[one_gene_per_bin.values].values
+    disp_mean_bin[one_gene_per_bin.values] = 0
+    bins = df['mean_bin'].values
+    dispersion_norm = ((df['dispersions'].values - disp_mean_bin[bins].values)
+                       / disp_std_bin[bins].values)
+
+    with np.errstate(invalid='ignore'):
+        highly_variable = ((mean > min_mean) & (mean < max_mean)
+                           & (dispersion_norm > min_disp) & (dispersion_norm < max_disp))
+    adata.var['highly_variable'] = highly_variable
+    adata.var['means'] = mean
+    adata.var['dispersions'] = dispersion
+    adata.var['dispersions_norm'] = dispersion_norm.astype(np.float32)
+    return adata
+
+def _prefix_mask(var_names, all_genes):
+    '''Boolean mask of the var_names that start with one of the genes in the
+    lists of all_genes.'''
+    prefixes = tuple(str(g) for genes in all_genes for g in genes)
+    if not prefixes:
+        return np.zeros(len(var_names), dtype=bool)
+    return np.fromiter((str(name).startswith(prefixes) for name in var_names),
+                       dtype=bool, count=len(var_names))
+
+@_profiled
+def select_genes(adata, all_genes = None, min_mean=0.0125, max_mean=3, min_disp=0.5):
+    '''Selects the highly variable genes and all the pathway genes in one
+    step. The dispersion statistics are computed in one sparse pass (see
+    highly_variable_genes) and the result is a compact, contiguous copy of
+    the selected genes, still sparse if adata.X is sparse. scale_data is
+    then the only place where the matrix is densified.
+    
+    Input:
+    adata : log-transformed AnnData object
+    all_genes : list of lists of genes of interest, the module pathways
+                (wnts, wntr, bmps, bmpr, notch) by default
+    
+    Output:
+    AnnData object with the selected genes
+    '''
+    if all_genes is None:
+        all_genes = [wnts, wntr, bmps, bmpr, notch]
+    highly_variable_genes(adata, min_mean=min_mean, max_mean=max_mean, min_disp=min_disp)
+    joint_genes = adata.var['highly_variable'].values | _prefix_mask(adata.var_names, all_genes)
+    return adata[:, joint_genes].copy()
+
+@_profiled
+def normalize_data(adata,count,min_mean=0.0125,max_mean=3,min_disp=0.5,highly_variable=True,**kwargs):
     '''This function normalizes the data, does a log(x+1) transformation, and sets a raw attribute
     of the anndata object. It also sets the highly-variable genes attribute of the anndata observation 
     parameters.
@@ -129,17 +599,26 @@ def normalize_data(adata,count,**kwargs):
     Inputs:
     adata: AnnData object
     count: value to normalize with
+    min_mean, max_mean, min_disp: cutoffs of the highly variable genes
+    highly_variable: whether to annotate the highly variable genes here. Pass False when
+    select_genes follows, it computes them itself.
     **kwargs: any other arguments to normalize the total with (applied to sc.pp.normalize_total fxn)
     '''
-    sc.pp.normalize_total(adata, target_sum=count, **kwargs)
-    sc.pp.log1p(adata)
+    adata.X = _as_precision(adata.X)
+    with _stage('normalize_total'):
+        sc.pp.normalize_total(adata, target_sum=count, **kwargs)
+    with _stage('log1p'):
+        sc.pp.log1p(adata)
     adata.raw=adata
-    sc.pp.highly_variable_genes(adata, min_mean=0.0125, max_mean=3, min_disp=0.5)
+    if highly_variable:
+        with _stage('highly_variable_genes'):
+            highly_variable_genes(adata, min_mean=min_mean, max_mean=max_mean, min_disp=min_disp)
     return adata
 
+@_profiled
 def merge_genes(adata, all_genes):
-    '''This function "densifies" the anndata object. It preserves highly variable genes and all genes of
-    interest.
+    '''This function keeps only the highly variable genes (already annotated, e.g. by normalize_data)
+    and all genes of interest. select_genes does the annotation and this selection in one step.
     Input: 
     
     adata: the AnnData object
@@ -147,29 +626,298 @@ def merge_genes(adata, all_genes):
     
     Output:
     
-    AnnData object
+    AnnData object with only the selected genes. It is a compact copy (still sparse if the
+    input is), not a view.
     '''
-    joint_genes=adata.var.highly_variable
-    for i in all_genes:
-        for j in i:
-            joint_genes = joint_genes|adata.var_names.str.startswith(j)
-    adata=adata[:,joint_genes]
+    joint_genes = adata.var.highly_variable.values | _prefix_mask(adata.var_names, all_genes)
+    adata=adata[:,joint_genes].copy()
     return adata
 
-def scale_data(adata):
+@_profiled
+def scale_data(adata, chunked=None, **kwargs):
     '''This function regresses out the AnnData object againist total counts per cell, and scales the 
     gene expression matrix so that each gene has zero mean and unit variance.
     Input:
     adata: AnnData object with ['n_total_counts_per_cell'] parameter in observations
+    chunked: use the memory-bounded float32 implementation (scale_data_chunked). By default
+    it is used in float32 mode (see set_precision).
+    **kwargs: passed to scale_data_chunked
     
     Output:
     AnnData object
     '''
-    sc.pp.regress_out(adata, ['n_total_counts_per_cell'])
-    sc.pp.scale(adata)
+    if chunked is None:
+        chunked = _precision['dtype'] is np.float32
+    if chunked:
+        return scale_data_chunked(adata, **kwargs)
+    with _stage('regress_out'):
+        sc.pp.regress_out(adata, ['n_total_counts_per_cell'])
+    with _stage('scale'):
+        sc.pp.scale(adata)
     return adata
 
-def marker_gene_expression(anndata, marker_dict, gene_symbol_key=None, partition_key='leiden'):
+def _row_blocks(n, rows):
+    return [(start, min(start + rows, n)) for start in range(0, n, rows)]
+
+def _dense_block(X, start, stop):
+    block = X[start:stop]
+    block = block.toarray() if sp.issparse(block) else block
+    return np.asarray(block, dtype=np.float64)
+
+@_profiled
+def scale_data_chunked(adata, regressor='n_total_counts_per_cell', max_value=None, out=None,
+                       max_memory=None, dtype=np.float32):
+    '''Memory-bounded version of scale_data. The linear regression on the
+    regressor and the column statistics are computed in one streaming pass
+    over row blocks of adata.X (sparse blocks stay sparse). A second pass
+    writes the scaled residuals block by block into a preallocated float32
+    buffer, so the float64 dense matrix is never materialized.
+    
+    Input:
+    adata: AnnData object
+    regressor: obs column to regress out, None to only scale
+    max_value: clip the scaled values above this value (like sc.pp.scale)
+    out: None to allocate the output in memory, a path to write it to a
+         memory-mapped .npy file, or a preallocated (cells x genes) array. With a
+         memory budget (set_resource_limits), an output larger than half of it is
+         spilled to a memory-mapped file in the spill directory, deleted once the
+         output is no longer referenced.
+    max_memory: bound (in bytes) of the working memory besides the output, a
+         quarter of the memory budget (or 1 GB) by default
+    dtype: dtype of the output
+    
+    Output:
+    AnnData object whose X is the scaled matrix. The results agree with
+    scale_data up to float32 rounding.
+    '''
+    X = adata.X
+    n, m = X.shape
+    x = None if regressor is None else adata.obs[regressor].values.astype(np.float64)
+    if max_memory is None:
+        max_memory = _memory_budget(2**30, 0.25)
+    rows = max(1, int(max_memory // (3 * 8 * max(m, 1))))
+    blocks = _row_blocks(n, rows)
+
+    with _stage('moments'):
+        sy, syy, sxy = np.zeros(m), np.zeros(m), np.zeros(m)
+        for start, stop in blocks:
+            block = X[start:stop]
+            if sp.issparse(block):
+                block = sp.csr_matrix(block)
+                values = block.data.astype(np.float64)
+                sy += np.bincount(block.indices, weights=values, minlength=m)
+                syy += np.bincount(block.indices, weights=values * values, minlength=m)
+                if x is not None:
+                    cell = np.repeat(np.arange(start, stop), np.diff(block.indptr))
+                    sxy += np.bincount(block.indices, weights=values * x[cell], minlength=m)
+            else:
+                block = np.asarray(block, dtype=np.float64)
+                sy += block.sum(0)
+                syy += np.einsum('ij,ij->j', block, block)
+                if x is not None:
+                    sxy += x[start:stop] @ block
+
+    # Ordinary least squares y = b0 + b1 * x for every gene, the residuals
+    # have zero mean and a variance of var(y) - cov(x, y)^2 / var(x)
+    mean_y = sy / n
+    ss_y = syy - n * mean_y**2
+    if x is not None:
+        mean_x = x.mean()
+        ss_x = ((x - mean_x)**2).sum()
+        sp_xy = sxy - n * mean_x * mean_y
+        b1 = sp_xy / ss_x if ss_x > 0 else np.zeros(m)
+        ss_r = ss_y - b1 * sp_xy
+    else:
+        mean_x, b1, ss_r = 0.0, np.zeros(m), ss_y
+    b0 = mean_y - b1 * mean_x
+    std = np.sqrt(np.maximum(ss_r, 0) / max(n - 1, 1))
+    std[std == 0] = 1
+
+    if out is None and n * m * np.dtype(dtype).itemsize > _memory_budget(np.inf, 0.5):
+        out = _spill((n, m), dtype, 'scaled_')
+    if out is None:
+        out = np.empty((n, m), dtype=dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=(n, m))
+    with _stage('write'):
+        for start, stop in blocks:
+            block = _dense_block(X, start, stop)
+            block -= b0
+            if x is not None:
+                block -= np.outer(x[start:stop], b1)
+            block /= std
+            if max_value is not None:
+                block[block > max_value] = max_value
+            out[start:stop] = block
+    if isinstance(out, np.memmap):
+        out.flush()
+    adata.X = out
+    return adata
+
+# Chunked backend for the expression summaries (gene_expression,
+# gene_expression_norm, marker_gene_expression and evaluate_partition). The
+# cells are split into row blocks, per-cluster sums and counts of the needed
+# genes are computed for each block in parallel workers and then reduced into
+# the usual cluster x gene tables. Only a local scheduler is used (threads or
+# processes).
+
+_chunked = {'enabled': False, 'n_jobs': None, 'chunk_size': 20000, 'scheduler': 'threads'}
+
+def set_chunked_backend(enabled = True, n_jobs = None, chunk_size = None, scheduler = None):
+    '''Turns the chunked backend of the expression summaries on or off.
+    
+    Input:
+    enabled : whether the expression summaries use the chunked backend by
+              default (passing n_jobs to one of them always does)
+    n_jobs : number of workers, all cores by default
+    chunk_size : number of cells per row block
+    scheduler : 'threads' (default) or 'processes'
+    '''
+    if scheduler not in (None, 'threads', 'processes'):
+        raise ValueError("scheduler should be 'threads' or 'processes'")
+    _chunked['enabled'] = enabled
+    if n_jobs is not None:
+        _chunked['n_jobs'] = n_jobs
+    if chunk_size is not None:
+        _chunked['chunk_size'] = chunk_size
+    if scheduler is not None:
+        _chunked['scheduler'] = scheduler
+
+def _use_chunked(n_jobs):
+    return n_jobs is not None or _chunked['enabled']
+
+def _parallel_map(fn, tasks, n_jobs = 1, scheduler = 'threads'):
+    '''Applies fn to every tuple of arguments in tasks with n_jobs workers
+    and returns the results in order. At most 2 * n_jobs tasks are in
+    flight, so tasks can be a generator producing large arguments.'''
+    _note('workers', max(1, n_jobs))
+    if n_jobs <= 1:
+        return [fn(*t) for t in tasks]
+    executor = ProcessPoolExecutor if scheduler == 'processes' else ThreadPoolExecutor
+    results = []
+    pending = collections.deque()
+    with executor(n_jobs) as ex:
+        for t in tasks:
+            pending.append(ex.submit(fn, *t))
+            if len(pending) >= 2 * n_jobs:
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+    return results
+
+# Number of cells summed in float32 at a time: a float32 block is summed in
+# float32 (no float64 copy of it) over at most this many cells, and these
+# partial sums are accumulated in float64
+_float32_sum_rows = 1024
+
+def _group_sums(block, codes, n_groups, dtype):
+    rows = np.flatnonzero(codes >= 0)
+    indicator = sp.csr_matrix((np.ones(len(rows), dtype=dtype), (codes[rows], rows)),
+                              shape=(n_groups, block.shape[0]))
+    sums = indicator @ block
+    return np.asarray(sums.toarray() if sp.issparse(sums) else sums, dtype=np.float64)
+
+def _partial_sums(block, codes, n_groups, squares):
+    '''Per-group sums of the columns of block (cells x genes) and counts of
+    cells per group. Cells with a negative code are not counted. If squares,
+    also returns the column sums and sums of squares over all cells.'''
+    if block.dtype == np.float32:
+        sums = np.zeros((n_groups, block.shape[1]))
+        for start in range(0, block.shape[0], _float32_sum_rows):
+            stop = start + _float32_sum_rows
+            sums += _group_sums(block[start:stop], codes[start:stop], n_groups, np.float32)
+    else:
+        sums = _group_sums(block, codes, n_groups, np.float64)
+    counts = np.bincount(codes[codes >= 0], minlength=n_groups)
+    if not squares:
+        return sums, counts, None, None
+    if sp.issparse(block):
+        colsum = np.asarray(block.sum(0, dtype=np.float64)).ravel()
+        sumsq = np.asarray(block.multiply(block).sum(0, dtype=np.float64)).ravel()
+    else:
+        block = np.asarray(block)
+        colsum = block.sum(0, dtype=np.float64)
+        sumsq = np.einsum('ij,ij->j', block, block, dtype=np.float64)
+    return sums, counts, colsum, sumsq
+
+def _block_sums(X, start, stop, cols, codes, n_groups, squares):
+    return _partial_sums(X[start:stop][:, cols], codes[start:stop], n_groups, squares)
+
+def _cluster_chunk(n_jobs, n_cols):
+    '''Rows per block of _cluster_means: the chunk_size of the chunked
+    backend, made smaller if needed to fit the memory budget, in which every
+    worker holds a dense float64 block of the needed genes plus its partial
+    sums. The budget never makes the blocks larger, so it never reduces the
+    number of blocks (and of busy workers).'''
+    chunk = _chunked['chunk_size']
+    if _resources['memory'] is not None:
+        chunk = min(chunk, max(1, _memory_budget(0, 0.5) // (n_jobs * 16 * max(n_cols, 1))))
+    return chunk
+
+def _cluster_means(X, cols, codes, n_groups, z_score = False, n_jobs = None):
+    '''Mean of the columns cols of X in each group (n_groups x len(cols)),
+    computed over row blocks in parallel. With z_score the means are those
+    of the z-scored columns, i.e. what sc.pp.scale followed by a mean over
+    the cells of each group gives. Empty groups are NaN.'''
+    n = X.shape[0]
+    n_jobs = _max_workers(n_jobs or _chunked['n_jobs'])
+    chunk = _cluster_chunk(n_jobs, len(cols))
+    # Without cells there is still one (empty) block, so the sums have their shape
+    bounds = [(start, min(start + chunk, n)) for start in range(0, n, chunk)] or [(0, 0)]
+    if _chunked['scheduler'] == 'processes' and n_jobs > 1:
+        tasks = ((X[start:stop][:, cols], codes[start:stop], n_groups, z_score)
+                 for start, stop in bounds)
+        parts = _parallel_map(_partial_sums, tasks, n_jobs, 'processes')
+    else:
+        tasks = ((X, start, stop, cols, codes, n_groups, z_score) for start, stop in bounds)
+        parts = _parallel_map(_block_sums, tasks, min(n_jobs, len(bounds)), 'threads')
+    sums = sum(p[0] for p in parts)
+    counts = sum(p[1] for p in parts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts[:, None]
+        if z_score:
+            # sc.pp.scale uses the unbiased variance and leaves constant genes
+            # at 1; a single cell has zero variance like in scale_data_chunked
+            mean = sum(p[2] for p in parts) / n
+            var = (sum(p[3] for p in parts) - n * mean**2) / max(n - 1, 1)
+            std = np.sqrt(np.maximum(var, 0))
+            std[std == 0] = 1
+            means = (means - mean) / std
+    return means
+
+def _gene_indices(gene_ids, genes):
+    '''The genes that are found in gene_ids, with the column indices each of
+    them maps to (there may be multiple mappings).'''
+    found = []
+    for gene in genes:
+        idx = np.flatnonzero(np.in1d(gene_ids, gene))
+        if len(idx):
+            found.append((gene, idx))
+    return found
+
+def _chunked_gene_expression(X, gene_ids, marker_list, codes, clusters, z_score = False,
+                             col_index = None, n_jobs = None):
+    '''Chunked counterpart of the gene_expression loop: a genes x clusters
+    table of the mean expression of every gene of marker_list that is found.
+    col_index maps the positions in gene_ids to the columns of X.'''
+    found = _gene_indices(gene_ids, marker_list)
+    if found:
+        cols = np.unique(np.concatenate([idx for _, idx in found]))
+    else:
+        cols = np.array([], dtype=int)
+    x_cols = cols if col_index is None else col_index[cols]
+    if np.any(x_cols < 0):
+        # get_indexer gives -1 for genes that are not in X (like slicing raw
+        # with them does in the unchunked path)
+        raise KeyError('genes not found in raw: %s' % ', '.join(map(str, np.asarray(gene_ids)[cols[x_cols < 0]])))
+    means = _cluster_means(X, x_cols, codes, len(clusters), z_score, n_jobs)
+    values = np.empty((len(found), len(clusters)))
+    for i, (gene, idx) in enumerate(found):
+        values[i] = means[:, np.searchsorted(cols, idx)].mean(1)
+    return pd.DataFrame(values, index=[gene for gene, _ in found], columns=clusters)
+
+@_profiled
+def marker_gene_expression(anndata, marker_dict, gene_symbol_key=None, partition_key='leiden', n_jobs=None):
     """
     A function to get mean z-score expressions of marker genes
      
@@ -180,7 +928,9 @@ def marker_gene_expression(anndata, marker_dict, gene_symbol_key=None, partition
         gene_symbol_key - The key for the anndata.var field with gene IDs or names that correspond to the marker 
                           genes
         partition_key   - The key for the anndata.obs field where the cluster IDs are stored. The default is
-                          'louvain_r1' 
+                          'louvain_r1'
+        n_jobs          - Number of workers of the chunked backend (see set_chunked_backend). If None, the
+                          chunked backend is only used when it has been enabled globally.
     """
 
     #Test inputs
@@ -204,8 +954,22 @@ def marker_gene_expression(anndata, marker_dict, gene_symbol_key=None, partition
     marker_exp = pd.DataFrame(columns=clusters)
     marker_exp['cell_type'] = pd.Series({}, dtype='str')
     marker_names = []
+
+    if _use_chunked(n_jobs):
+        codes = anndata.obs[partition_key].cat.codes.values.astype(np.int64)
+        genes = list(dict.fromkeys(g for group in marker_dict for g in marker_dict[group]))
+        with _stage('chunked_means'):
+            table = _chunked_gene_expression(anndata.X, gene_ids, genes, codes, clusters,
+                                             z_score=True, n_jobs=n_jobs)
+        frames = []
+        for group in marker_dict:
+            rows = table.loc[[g for g in marker_dict[group] if g in table.index]].copy()
+            rows['cell_type'] = group
+            frames.append(rows)
+        return pd.concat(frames) if frames else marker_exp
     
-    z_scores = sc.pp.scale(anndata, copy=True)
+    with _stage('scale'):
+        z_scores = sc.pp.scale(anndata, copy=True)
 
     i = 0
     for group in marker_dict:
@@ -218,7 +982,8 @@ def marker_gene_expression(anndata, marker_dict, gene_symbol_key=None, partition
                 z_scores.obs[ens_idx[0]] = z_scores.X[:,ens_idx].mean(1) #works for both single and multiple mapping
                 ens_idx = ens_idx[0]
 
-            clust_marker_exp = z_scores.obs.groupby(partition_key)[ens_idx].apply(np.mean).tolist()
+            with _stage('groupby'):
+                clust_marker_exp = z_scores.obs.groupby(partition_key)[ens_idx].apply(np.mean).tolist()
             clust_marker_exp.append(group)
             marker_exp.loc[i] = clust_marker_exp
             marker_names.append(gene)
@@ -229,7 +994,8 @@ def marker_gene_expression(anndata, marker_dict, gene_symbol_key=None, partition
 
     return(marker_exp)
 
-def gene_expression(anndata, marker_list, gene_symbol_key=None, partition_key='leiden'):
+@_profiled
+def gene_expression(anndata, marker_list, gene_symbol_key=None, partition_key='leiden', n_jobs=None):
     """A function to get mean z-score expressions of marker genes
      
      Inputs:
@@ -239,7 +1005,9 @@ def gene_expression(anndata, marker_list, gene_symbol_key=None, partition_key='l
         gene_symbol_key - The key for the anndata.var field with gene IDs or names that correspond to the marker 
                           genes
         partition_key   - The key for the anndata.obs field where the cluster IDs are stored. The default is
-                          'louvain_r1' """
+                          'louvain_r1'
+        n_jobs          - Number of workers of the chunked backend (see set_chunked_backend). If None, the
+                          chunked backend is only used when it has been enabled globally."""
 
     #Test inputs
     if partition_key not in anndata.obs.columns.values:
@@ -262,6 +1030,12 @@ def gene_expression(anndata, marker_list, gene_symbol_key=None, partition_key='l
     marker_exp = pd.DataFrame(columns=clusters)
     marker_names = []
 
+    if _use_chunked(n_jobs):
+        codes = anndata.obs[partition_key].cat.codes.values.astype(np.int64)
+        with _stage('chunked_means'):
+            return _chunked_gene_expression(anndata.X, gene_ids, marker_list, codes, clusters,
+                                            n_jobs=n_jobs)
+
     i = 0
     
     for gene in marker_list:
@@ -272,7 +1046,8 @@ def gene_expression(anndata, marker_list, gene_symbol_key=None, partition_key='l
             anndata.obs[ens_idx[0]] = anndata.X[:,ens_idx].mean(1) #works for both single and multiple mapping
             ens_idx = ens_idx[0]
 
-        clust_marker_exp = anndata.obs.groupby(partition_key)[ens_idx].apply(np.mean).tolist()
+        with _stage('groupby'):
+            clust_marker_exp = anndata.obs.groupby(partition_key)[ens_idx].apply(np.mean).tolist()
         marker_exp.loc[i] = clust_marker_exp
         marker_names.append(gene)
         i+=1
@@ -282,7 +1057,8 @@ def gene_expression(anndata, marker_list, gene_symbol_key=None, partition_key='l
 
     return(marker_exp)
 
-def gene_expression_norm(anndata, marker_list, gene_symbol_key=None, partition_key='leiden'):
+@_profiled
+def gene_expression_norm(anndata, marker_list, gene_symbol_key=None, partition_key='leiden', n_jobs=None):
     """A function to get normalized expressions of marker genes
      
      Inputs:
@@ -292,7 +1068,9 @@ def gene_expression_norm(anndata, marker_list, gene_symbol_key=None, partition_k
         gene_symbol_key - The key for the anndata.var field with gene IDs or names that correspond to the marker 
                           genes
         partition_key   - The key for the anndata.obs field where the cluster IDs are stored. The default is
-                          'louvain_r1' """
+                          'louvain_r1'
+        n_jobs          - Number of workers of the chunked backend (see set_chunked_backend). If None, the
+                          chunked backend is only used when it has been enabled globally."""
 
     #Test inputs
     if partition_key not in anndata.obs.columns.values:
@@ -314,6 +1092,14 @@ def gene_expression_norm(anndata, marker_list, gene_symbol_key=None, partition_k
     n_clust = len(clusters)
     marker_exp = pd.DataFrame(columns=clusters)
     marker_names = []
+
+    if _use_chunked(n_jobs):
+        # Read the normalized values straight from raw instead of slicing it
+        codes = anndata.obs[partition_key].cat.codes.values.astype(np.int64)
+        col_index = anndata.raw.var_names.get_indexer(anndata.var_names)
+        with _stage('chunked_means'):
+            return _chunked_gene_expression(anndata.raw.X, gene_ids, marker_list, codes, clusters,
+                                            col_index=col_index, n_jobs=n_jobs)
     
     i = 0
     
@@ -327,7 +1113,8 @@ def gene_expression_norm(anndata, marker_list, gene_symbol_key=None, partition_k
             ann_data.obs[ens_idx[0]] = ann_data.raw[:, ann_data.var.index].X[:,ens_idx].mean(1) #works for both single and multiple mapping
             ens_idx = ens_idx[0]
 
-        clust_marker_exp = ann_data.obs.groupby(partition_key)[ens_idx].apply(np.mean).tolist()
+        with _stage('groupby'):
+            clust_marker_exp = ann_data.obs.groupby(partition_key)[ens_idx].apply(np.mean).tolist()
         marker_exp.loc[i] = clust_marker_exp
         marker_names.append(gene)
         i+=1        
@@ -338,7 +1125,8 @@ def gene_expression_norm(anndata, marker_list, gene_symbol_key=None, partition_k
     return(marker_exp)
 
 #Define cluster score for all markers
-def evaluate_partition(anndata, marker_dict, gene_symbol_key=None, partition_key='leiden'):
+@_profiled
+def evaluate_partition(anndata, marker_dict, gene_symbol_key=None, partition_key='leiden', n_jobs=None):
     ''' This function gives a cell-type score for each partition key (i.e. Leiden clusters)
     Inputs:
     
@@ -349,6 +1137,8 @@ def evaluate_partition(anndata, marker_dict, gene_symbol_key=None, partition_key
                       genes
     partition_key   - The key for the anndata.obs field where the cluster IDs are stored. The default is
                       'louvain_r1'
+    n_jobs          - Number of workers of the chunked backend (see set_chunked_backend). If None, the
+                      chunked backend is only used when it has been enabled globally.
     Returns:
     
     A dataframe with a score for each cell type.
@@ -375,18 +1165,32 @@ def evaluate_partition(anndata, marker_dict, gene_symbol_key=None, partition_key
     n_groups = len(marker_dict)
     
     marker_res = np.zeros((n_groups, n_clust))
-    z_scores = sc.pp.scale(anndata, copy=True)
 
-    i = 0
-    for group in marker_dict:
-        # Find the corresponding columns and get their mean expression in the cluster
-        j = 0
-        for clust in clusters:
-            cluster_cells = np.in1d(z_scores.obs[partition_key], clust)
-            marker_genes = np.in1d(gene_ids, marker_dict[group])
-            marker_res[i,j] = z_scores.X[np.ix_(cluster_cells,marker_genes)].mean()
-            j += 1
-        i+=1
+    if _use_chunked(n_jobs):
+        # The mean over cells and marker genes is the mean over the marker
+        # genes of their per-cluster z-score means.
+        codes = np.unique(anndata.obs[partition_key], return_inverse=True)[1].astype(np.int64)
+        masks = [np.in1d(gene_ids, marker_dict[group]) for group in marker_dict]
+        cols = np.flatnonzero(np.any(masks, axis=0)) if masks else np.array([], dtype=int)
+        with _stage('chunked_means'):
+            means = _cluster_means(anndata.X, cols, codes, n_clust, z_score=True, n_jobs=n_jobs)
+        for i, mask in enumerate(masks):
+            with np.errstate(invalid='ignore'):
+                marker_res[i] = means[:, np.in1d(cols, np.flatnonzero(mask))].mean(1)
+    else:
+        with _stage('scale'):
+            z_scores = sc.pp.scale(anndata, copy=True)
+
+        i = 0
+        for group in marker_dict:
+            # Find the corresponding columns and get their mean expression in the cluster
+            j = 0
+            for clust in clusters:
+                cluster_cells = np.in1d(z_scores.obs[partition_key], clust)
+                marker_genes = np.in1d(gene_ids, marker_dict[group])
+                marker_res[i,j] = z_scores.X[np.ix_(cluster_cells,marker_genes)].mean()
+                j += 1
+            i+=1
 
     variances = np.nanvar(marker_res, axis=0)
     if np.all(np.isnan(variances)):
@@ -399,28 +1203,300 @@ def evaluate_partition(anndata, marker_dict, gene_symbol_key=None, partition_key
     #Return the median of the variances over the clusters
     return(marker_res_df)
 
-def silhouette_analysis(range_n_clusters, X):
+# Permutation tests of the pathway expression of the clusters. The labels
+# are shuffled many times; for a block of permutations all the permuted
+# cluster x gene means come from one sparse product of a stacked indicator
+# matrix (permutations * clusters x cells) with the cells x genes matrix. The
+# blocks run in a process pool and only the exceedance counts are returned.
+
+_permutation_state = {}
+
+def _init_permutation_worker(Xg, codes, counts, observed, center):
+    _permutation_state.update(Xg=Xg, codes=codes, counts=counts,
+                              observed=observed, center=center)
+
+def _permutation_block(seeds):
+    '''Counts, for one block of label permutations (one seed each), how
+    often the permuted means are at least as extreme as the observed ones.'''
+    st = _permutation_state
+    codes, counts, observed, center = st['codes'], st['counts'], st['observed'], st['center']
+    n, k, n_perm = len(codes), len(counts), len(seeds)
+    rows = np.concatenate([np.random.default_rng(sd).permutation(codes) + b * k
+                           for b, sd in enumerate(seeds)])
+    indicator = sp.csr_matrix((np.ones(n * n_perm), (rows, np.tile(np.arange(n), n_perm))),
+                              shape=(n_perm * k, n))
+    sums = indicator @ st['Xg']
+    sums = sums.toarray() if sp.issparse(sums) else np.asarray(sums)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums.reshape(n_perm, k, -1) / counts[None, :, None]
+    tol = 1e-12 * max(1.0, np.nanmax(np.abs(observed)) if observed.size else 1.0)
+    greater = (means >= observed - tol).sum(0)
+    less = (means <= observed + tol).sum(0)
+    both = (np.abs(means - center) >= np.abs(observed - center) - tol).sum(0)
+    return greater, less, both
+
+def fdr_bh(pvalues):
+    '''Benjamini-Hochberg adjusted p-values (NaN values are left out).'''
+    p = np.asarray(pvalues, dtype=float)
+    flat = p.ravel()
+    ok = ~np.isnan(flat)
+    q = np.full(flat.shape, np.nan)
+    pv = flat[ok]
+    n = len(pv)
+    if n:
+        order = np.argsort(pv)
+        ranked = pv[order] * n / np.arange(1, n + 1)
+        ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+        q_ok = np.empty(n)
+        q_ok[order] = np.minimum(ranked, 1)
+        q[ok] = q_ok
+    return q.reshape(p.shape)
+
+@_profiled
+def permutation_test(anndata, marker_list, n_permutations=1000, norm=False, alternative='greater',
+                     gene_symbol_key=None, partition_key='leiden', block_size=None, seed=0,
+                     n_jobs=None):
+    '''Empirical significance of the mean expression of marker genes in each
+    cluster, by shuffling the cluster labels of the cells.
+    
+    Inputs:
+    anndata         - An AnnData object containing the data set and a partition
+    marker_list     - list of genes (e.g. one of the pathways)
+    n_permutations  - number of label permutations
+    norm            - use the normalized data in anndata.raw instead of anndata.X (like
+                      gene_expression_norm)
+    alternative     - 'greater' (cluster mean higher than by chance), 'less' or 'two-sided'
+                      (distance from the overall mean of the gene)
+    block_size      - permutations per sparse product, chosen from the number of cells if None
+    seed            - seed of the permutations. Every permutation has its own child seed, so the
+                      results do not depend on n_jobs, block_size or the memory budget
+    n_jobs          - number of worker processes, all cores by default
+    
+    Returns:
+    three genes x clusters DataFrames: the observed means (as gene_expression), the
+    empirical p-values and the Benjamini-Hochberg FDR over all the tests
+    '''
+    if alternative not in ('greater', 'less', 'two-sided'):
+        raise ValueError("alternative should be 'greater', 'less' or 'two-sided'")
+    gene_ids = anndata.var[gene_symbol_key] if gene_symbol_key else anndata.var_names
+    clusters = anndata.obs[partition_key].cat.categories
+    codes = anndata.obs[partition_key].cat.codes.values.astype(np.int64)
+    found = _gene_indices(gene_ids, marker_list)
+    genes = [gene for gene, _ in found]
+    if not found:
+        empty = pd.DataFrame(columns=clusters)
+        return empty, empty.copy(), empty.copy()
+
+    # Cells x genes matrix, averaging the columns a gene maps to
+    cols = np.unique(np.concatenate([idx for _, idx in found]))
+    pos = np.concatenate([np.searchsorted(cols, idx) for _, idx in found])
+    gene_of = np.concatenate([np.full(len(idx), i) for i, (_, idx) in enumerate(found)])
+    weights = np.concatenate([np.full(len(idx), 1.0 / len(idx)) for _, idx in found])
+    M = sp.csr_matrix((weights, (pos, gene_of)), shape=(len(cols), len(found)))
+    if norm:
+        X = anndata.raw.X
+        raw_cols = anndata.raw.var_names.get_indexer(anndata.var_names)[cols]
+        if np.any(raw_cols < 0):
+            # get_indexer gives -1 for genes that are not in raw
+            raise KeyError('genes not found in raw: %s' % ', '.join(map(str, np.asarray(gene_ids)[cols[raw_cols < 0]])))
+        cols = raw_cols
+    else:
+        X = anndata.X
+    labeled = np.flatnonzero(codes >= 0)
+    with _stage('gene_matrix'):
+        Xg = X[:, cols][labeled] @ M
+        Xg = sp.csr_matrix(Xg) if sp.issparse(Xg) else np.asarray(Xg, dtype=np.float64)
+    codes = codes[labeled]
+
+    k = len(clusters)
+    counts = np.bincount(codes, minlength=k).astype(np.float64)
+    indicator = sp.csr_matrix((np.ones(len(codes)), (codes, np.arange(len(codes)))),
+                              shape=(k, len(codes)))
+    sums = indicator @ Xg
+    sums = sums.toarray() if sp.issparse(sums) else np.asarray(sums)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        observed = sums / counts[:, None]
+    center = np.asarray(Xg.sum(0)).ravel() / max(len(codes), 1)
+
+    n_jobs = _max_workers(n_jobs)
+    if block_size is None:
+        # About 40 bytes per entry of the stacked indicator matrix per worker
+        entries = _memory_budget(40 * 2 * 10**7, 0.5) // (40 * n_jobs)
+        block_size = int(max(1, min(n_permutations, entries // max(len(codes), 1))))
+    seeds = np.random.SeedSequence(seed).spawn(n_permutations)
+    blocks = [seeds[start:start + block_size] for start in range(0, n_permutations, block_size)]
+    n_jobs = min(n_jobs, len(blocks))
+    _note('workers', n_jobs)
+    state = (Xg, codes, counts, observed, center)
+    with _stage('permutations'):
+        if n_jobs <= 1:
+            _init_permutation_worker(*state)
+            parts = [_permutation_block(block) for block in blocks]
+            _permutation_state.clear()
+        else:
+            with ProcessPoolExecutor(n_jobs, initializer=_init_permutation_worker,
+                                     initargs=state) as ex:
+                parts = list(ex.map(_permutation_block, blocks))
+    which = {'greater': 0, 'less': 1, 'two-sided': 2}[alternative]
+    exceed = sum(part[which] for part in parts)
+    pvalues = (exceed + 1.0) / (n_permutations + 1.0)
+    pvalues[counts == 0] = np.nan
+    fdr = fdr_bh(pvalues)
+
+    table = lambda values: pd.DataFrame(values.T, index=genes, columns=clusters)
+    return table(observed), table(pvalues), table(fdr)
+
+# Marker-panel annotation of the clusters. The marker x cluster z-score
+# table is gathered into a preallocated float array from one pass of
+# per-cluster means over the union of the markers, and the cell types are
+# assigned to the clusters with a vectorized argmax and margin.
+
+@_profiled
+def marker_table(anndata, marker_dict, gene_symbol_key=None, partition_key='leiden', n_jobs=None):
+    '''Typed version of marker_gene_expression: mean z-score expression of
+    every marker in every cluster.
+    
+    Inputs:
+    anndata         - An AnnData object containing the data set and a partition
+    marker_dict     - A dictionary {cell type: list of markers}, markers given as var_names or as
+                      values of anndata.var[gene_symbol_key]
+    partition_key   - The key for the anndata.obs field where the cluster IDs are stored
+    n_jobs          - Number of workers, by default the n_jobs of set_chunked_backend or all cores
+                      (capped by set_resource_limits)
+    
+    Returns:
+    DataFrame with one row per (cell type, marker) found in the data: a categorical cell_type
+    column, a gene column and one float64 column per cluster
+    '''
+    if partition_key not in anndata.obs.columns.values:
+        raise KeyError('The partition key ' + repr(partition_key) + ' was not found in the passed AnnData object.')
+    gene_ids = anndata.var[gene_symbol_key] if gene_symbol_key else anndata.var_names
+    clusters = anndata.obs[partition_key].cat.categories
+    codes = anndata.obs[partition_key].cat.codes.values.astype(np.int64)
+
+    types = list(marker_dict.keys())
+    type_of = np.concatenate([np.full(len(marker_dict[t]), i) for i, t in enumerate(types)]) \
+        if types else np.array([], dtype=int)
+    markers = [g for t in types for g in marker_dict[t]]
+    found = dict(_gene_indices(gene_ids, list(dict.fromkeys(markers))))
+    keep = np.array([g in found for g in markers], dtype=bool)
+    genes = list(found.keys())
+    cols = np.unique(np.concatenate(list(found.values()))) if found else np.array([], dtype=int)
+    with _stage('cluster_means'):
+        means = _cluster_means(anndata.X, cols, codes, len(clusters), z_score=True, n_jobs=n_jobs)
+
+    # Genes mapping to several columns are averaged, then every (cell type,
+    # marker) row is gathered from the per-gene table
+    gene_table = np.empty((len(genes), len(clusters)))
+    for i, g in enumerate(genes):
+        gene_table[i] = means[:, np.searchsorted(cols, found[g])].mean(1)
+    row_gene = pd.Index(genes).get_indexer([g for g, k in zip(markers, keep) if k])
+    values = np.empty((len(row_gene), len(clusters)))
+    np.take(gene_table, row_gene, axis=0, out=values)
+
+    table = pd.DataFrame(values, columns=[str(c) for c in clusters])
+    table.insert(0, 'gene', np.array(markers, dtype=object)[keep])
+    table.insert(0, 'cell_type', pd.Categorical.from_codes(type_of[keep], categories=types))
+    return table
+
+@_profiled
+def annotate_clusters(anndata, marker_dict, min_margin=0.0, gene_symbol_key=None,
+                      partition_key='leiden', unassigned='unassigned', n_jobs=None):
+    '''Assigns a cell type to every cluster from a marker panel.
+    
+    The score of a cell type in a cluster is the mean z-score of its markers
+    (as in evaluate_partition). Every cluster gets the best scoring cell type,
+    or unassigned if it beats the second best by less than min_margin.
+    
+    Inputs:
+    anndata         - An AnnData object containing the data set and a partition
+    marker_dict     - A dictionary {cell type: list of markers}
+    min_margin      - minimal score difference between the best and the second best cell type
+    unassigned      - label of the clusters without a clear best cell type
+    
+    Returns:
+    table      - the marker x cluster table of marker_table
+    scores     - cell types x clusters table of scores
+    assignment - DataFrame indexed by cluster with the cell_type, its score and the margin
+    '''
+    table = marker_table(anndata, marker_dict, gene_symbol_key, partition_key, n_jobs)
+    types = table['cell_type'].cat.categories
+    values = table.iloc[:, 2:].values
+    type_codes = table['cell_type'].cat.codes.values
+    # Averaging matrix (cell types x marker rows) applied in one product
+    n_markers = np.bincount(type_codes, minlength=len(types)).astype(np.float64)
+    averaging = sp.csr_matrix((1.0 / n_markers[type_codes], (type_codes, np.arange(len(type_codes)))),
+                              shape=(len(types), len(type_codes)))
+    scores = np.asarray(averaging @ values)
+    scores[n_markers == 0] = np.nan
+
+    filled = np.where(np.isnan(scores), -np.inf, scores)
+    if len(types) > 1:
+        top2 = -np.sort(-filled, axis=0)[:2]
+        with np.errstate(invalid='ignore'):
+            margin = top2[0] - top2[1]
+    else:
+        margin = np.full(filled.shape[1], np.inf)
+    best = filled.argmax(0) if len(types) else np.zeros(filled.shape[1], dtype=int)
+    best_score = filled[best, np.arange(filled.shape[1])] if len(types) else np.full(filled.shape[1], np.nan)
+    labels = np.asarray(types, dtype=object)[best] if len(types) else np.full(filled.shape[1], unassigned, dtype=object)
+    with np.errstate(invalid='ignore'):
+        ambiguous = ~np.isfinite(best_score) | (margin < min_margin)
+    labels = np.where(ambiguous, unassigned, labels)
+
+    clusters = table.columns[2:]
+    scores = pd.DataFrame(scores, index=types, columns=clusters)
+    assignment = pd.DataFrame({'cell_type': pd.Categorical(labels, categories=list(types) + [unassigned]),
+                               'score': np.where(np.isfinite(best_score), best_score, np.nan),
+                               'margin': margin}, index=clusters)
+    return table, scores, assignment
+
+def _silhouette_trials(X, n_clusters, n_trials, single_thread = False):
+    '''Silhouette scores of n_trials KMeans fits of X. Module level so that
+    it can be sent to worker processes, where single_thread keeps KMeans to
+    one OpenMP/BLAS thread (the workers already use all the cores).'''
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
+    if single_thread:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    cluster_avg = []
+    for _ in range(n_trials):
+        with _stage('kmeans'):
+            clusterer = KMeans(n_clusters=n_clusters, random_state=10)
+            cluster_labels = clusterer.fit_predict(X)
+
+        # The silhouette_score gives the average value for all the samples.
+        # This gives a perspective into the density and separation of the formed
+        # clusters
+        with _stage('silhouette_score'):
+            silhouette_avg = silhouette_score(X, cluster_labels, metric='cosine')
+        cluster_avg.append(silhouette_avg)
+    return cluster_avg
+
+@_profiled
+def silhouette_analysis(range_n_clusters, X, n_jobs=None):
     '''This function takes as input a matrix X and a list of a range of
     clusters range_n_clusters (that should be from 2 - (n-1) where n is 
     the total number of clusters in the dataset) and yields as output
-    a list of the average silhouette score from 100 trials.'''
+    a list of the average silhouette score from 100 trials.
+    The trials run in n_jobs worker processes (capped by set_resource_limits).
+    By default they run in this process, or with the worker limit if one is
+    set.'''
+    range_n_clusters = list(range_n_clusters)
+    n_jobs = _max_workers(n_jobs) if n_jobs or _resources['workers'] else 1
+    # With fewer cluster numbers than workers, the trials of every cluster
+    # number are split between several tasks
+    parts = max(1, min(100, -(-n_jobs // max(len(range_n_clusters), 1))))
+    sizes = [len(c) for c in np.array_split(np.arange(100), parts)]
+    tasks = ((X, n_clusters, size, n_jobs > 1) for n_clusters in range_n_clusters for size in sizes)
+    results = iter(_parallel_map(_silhouette_trials, tasks, n_jobs, 'processes'))
     scores = []
     for n_clusters in range_n_clusters:
-        i=0
-        cluster_avg = []
-        while i < 100:
-            clusterer = KMeans(n_clusters=n_clusters, random_state=10)
-            cluster_labels = clusterer.fit_predict(X)
-
-    # The silhouette_score gives the average value for all the samples.
-    # This gives a perspective into the density and separation of the formed
-    # clusters
-            silhouette_avg = silhouette_score(X, cluster_labels, metric='cosine')
-            cluster_avg.append(silhouette_avg)
-            i+=1
-        scores.append((n_clusters, cluster_avg))
+        scores.append((n_clusters, [score for _ in sizes for score in next(results)]))
     return scores
 
+@_profiled
 def silhouette_plots(adata, pathway_names, pathway_genes, norm = False, ax=None):
     '''This function gives silhouette scores and boxplots of the scores
     sampled from 100 trials for different numbers of clusters on our 
@@ -444,7 +1520,7 @@ def silhouette_plots(adata, pathway_names, pathway_genes, norm = False, ax=None)
         df = gene_expression_norm(adata, pathway_genes)
     df = df.T
     df.reset_index(inplace=True)
-    X = df[df.columns[1:]].values
+    X = df[df.columns[1:]].values.astype(get_precision())
     score = silhouette_analysis(range_n_clusters, X)
     scores[pathway_names] = [np.mean(s[1]) for s in score]
     plot = [s[1] for s in score]
@@ -459,8 +1535,287 @@ def silhouette_plots(adata, pathway_names, pathway_genes, norm = False, ax=None)
     fig.tight_layout()
     return fig, scores
 
+# Linkage trees are cached per (dataset, pathway) so that different numbers of
+# pathway clusters can be explored without recomputing the expression table,
+# the cosine distances or the tree itself.
+_linkage_cache = {}
+
+def _dataset_cache(adata, cache):
+    '''Returns the per-dataset dictionary in cache for adata, creating it on
+    first use. The entry is dropped when adata is garbage collected.'''
+    key = id(adata)
+    if key not in cache:
+        cache[key] = {}
+        weakref.finalize(adata, cache.pop, key, None)
+    return cache[key]
+
+def _data_fingerprint(X, n_samples = 4096):
+    '''Cheap fingerprint of a (dense or sparse) matrix: its identity, shape,
+    dtype, number of stored values and a hash of an evenly strided sample of
+    the values. Changes whenever X is replaced, transformed in place (e.g.
+    scaled) or reallocated.'''
+    values = X.data if sp.issparse(X) else np.asarray(X)
+    flat = values.ravel(order='K')
+    step = max(1, flat.size // n_samples)
+    sample = np.ascontiguousarray(flat[::step][:n_samples])
+    return (id(X), X.shape, str(X.dtype), values.size,
+            hashlib.sha1(sample.tobytes()).hexdigest())
+
+@_profiled
+def pathway_linkage(adata, pathway_genes, norm = False, partition_key = 'leiden'):
+    '''Computes (once) the hierarchical clustering of the Leiden clusters
+    based on cosine distance of their pathway gene expression.
+    
+    Input:
+    adata : AnnData object
+    pathway_genes : a list of the genes in the pathway
+    norm : whether or not to use normalized data. z-score is default.
+    partition_key : the anndata.obs field with the cluster IDs
+    
+    Output:
+    df : dataframe of expression values (genes x clusters)
+    L : the linkage matrix of the clusters
+    '''
+    cache = _dataset_cache(adata, _linkage_cache)
+    X = adata.raw.X if norm and adata.raw is not None else adata.X
+    partition = adata.obs[partition_key].cat
+    # The cluster of every cell, not only the cluster names: re-running Leiden
+    # with the same number of clusters keeps the names '0' ... 'k-1'
+    assignments = hashlib.sha1(np.ascontiguousarray(partition.codes.values).tobytes()).hexdigest()
+    key = (tuple(pathway_genes), bool(norm), partition_key, adata.n_obs,
+           tuple(partition.categories), assignments, _data_fingerprint(X),
+           np.dtype(_precision['dtype']).name)
+    if key not in cache:
+        if norm:
+            df = gene_expression_norm(adata, pathway_genes, partition_key=partition_key)
+        else:
+            df = gene_expression(adata, pathway_genes, partition_key=partition_key)
+        with _stage('linkage'):
+            d = sch.distance.pdist(df.transpose(), metric='cosine')
+            cache[key] = (df, sch.linkage(d))
+    return cache[key]
+
+@_profiled
+def pathway_clusters(adata, pathway_genes, num_clust, norm = False, partition_key = 'leiden'):
+    '''Cuts the cached pathway linkage tree into num_clust clusters.
+    
+    Output:
+    A pandas Series indexed by the Leiden clusters with the (string) pathway
+    cluster each of them belongs to.
+    '''
+    df, L = pathway_linkage(adata, pathway_genes, norm, partition_key)
+    linkage = sch.fcluster(L, num_clust, 'maxclust')
+    return pd.Series([str(i) for i in linkage], index=df.columns)
+
+def clear_linkage_cache(adata = None):
+    '''Drops the cached linkage trees of adata, or of all datasets if adata
+    is None. Entries of data that changed are not reused anyway (the cache key
+    includes a fingerprint of the expression matrix), this only frees them.'''
+    if adata is None:
+        for cache in _linkage_cache.values():
+            cache.clear()
+    elif id(adata) in _linkage_cache:
+        _linkage_cache[id(adata)].clear()
+
+# Consensus clustering of the Leiden clusters on their pathway expression.
+# Many KMeans or hierarchical fits on random subsamples of the clusters run in
+# parallel; how often two clusters are sampled together and how often they
+# are assigned together is accumulated in condensed upper-triangular buffers
+# (the layout of scipy's pdist). The consensus labels and stability scores of
+# every number of clusters come out of one run.
+
+ConsensusResult = collections.namedtuple('ConsensusResult',
+                                         ['labels', 'stability', 'item_consensus', 'consensus', 'best_k'])
+
+def _condensed_index(i, j, n):
+    '''Position of the pair (i, j), i < j, in a condensed n x n buffer.'''
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+def _fit_labels(X, k, method, metric, rng):
+    if method == 'kmeans':
+        from sklearn.cluster import KMeans
+        if metric == 'cosine':
+            norms = np.linalg.norm(X, axis=1, keepdims=True)
+            X = X / np.where(norms == 0, 1, norms)
+        return KMeans(n_clusters=k, n_init=10, random_state=int(rng.integers(2**31 - 1))).fit_predict(X)
+    L = sch.linkage(sch.distance.pdist(X, metric=metric), 'average')
+    return sch.fcluster(L, k, 'maxclust')
+
+def _consensus_resamples(X, ks, seeds, subsample, method, metric):
+    '''Co-sampling counts and co-assignment counts (per k) of a chunk of
+    resamples, as condensed buffers.'''
+    n = X.shape[0]
+    m = max(2, int(round(subsample * n)))
+    sampled = np.zeros(n * (n - 1) // 2, dtype=np.int32)
+    together = {k: np.zeros(n * (n - 1) // 2, dtype=np.int32) for k in ks}
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        items = np.sort(rng.choice(n, size=m, replace=False))
+        a, b = np.triu_indices(m, 1)
+        pairs = _condensed_index(items[a], items[b], n)
+        sampled[pairs] += 1
+        for k in ks:
+            if k >= m:
+                continue
+            labels = _fit_labels(X[items], k, method, metric, rng)
+            together[k][pairs[labels[a] == labels[b]]] += 1
+    return sampled, together
+
+@_profiled
+def consensus_clustering(X, range_n_clusters, n_resamples=100, subsample=0.8, method='kmeans',
+                         metric='cosine', seed=0, n_jobs=None, index=None):
+    '''Consensus clustering of the rows of X for several numbers of clusters.
+    
+    Input:
+    X : items x features matrix (e.g. Leiden clusters x pathway genes)
+    range_n_clusters : numbers of clusters to evaluate
+    n_resamples : number of random subsamples
+    subsample : fraction of the items in each subsample
+    method : 'kmeans' or 'hierarchical' (average linkage on metric)
+    metric : 'cosine' (KMeans then runs on L2-normalized rows) or any pdist
+             metric for the hierarchical method
+    seed : seed of the subsamples, results do not depend on n_jobs
+    n_jobs : number of worker processes, all cores by default
+    index : labels of the items
+    
+    Output:
+    ConsensusResult with
+    labels : items x k table of the consensus labels (average linkage on 1 -
+             consensus)
+    stability : per k, the PAC score (fraction of pairs with an ambiguous
+                consensus between 0.1 and 0.9, lower is more stable), the
+                mean consensus within the clusters and the lowest item
+                consensus
+    item_consensus : items x k, mean consensus of every item with the other
+                     items of its cluster
+    consensus : dictionary k -> condensed consensus matrix
+    best_k : the k with the lowest PAC score
+    '''
+    X = np.asarray(X, dtype=float)
+    n = X.shape[0]
+    ks = [k for k in range_n_clusters if 1 < k < n]
+    seeds = np.random.SeedSequence(seed).spawn(n_resamples)
+    n_jobs = max(1, min(_max_workers(n_jobs), n_resamples))
+    chunks = [seeds[i::n_jobs * 4] for i in range(min(n_resamples, n_jobs * 4))]
+    tasks = ((X, ks, chunk, subsample, method, metric) for chunk in chunks)
+
+    sampled = np.zeros(n * (n - 1) // 2, dtype=np.int64)
+    together = {k: np.zeros_like(sampled) for k in ks}
+    with _stage('resamples'):
+        for part_sampled, part_together in _parallel_map(_consensus_resamples, tasks, n_jobs, 'processes'):
+            sampled += part_sampled
+            for k in ks:
+                together[k] += part_together[k]
+
+    index = pd.Index(index if index is not None else range(n))
+    labels, item_consensus, stability, consensus = {}, {}, [], {}
+    for k in ks:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            C = np.where(sampled > 0, together[k] / sampled, 0.0)
+        consensus[k] = C
+        lab = sch.fcluster(sch.linkage(1 - C, 'average'), k, 'maxclust')
+        square = sch.distance.squareform(C)
+        same = lab[:, None] == lab[None, :]
+        np.fill_diagonal(same, False)
+        with np.errstate(invalid='ignore'):
+            item = (square * same).sum(1) / same.sum(1)
+        within = C[same[np.triu_indices(n, 1)]]
+        labels[k] = lab
+        item_consensus[k] = item
+        stability.append({'n_clusters': k,
+                          'pac': np.mean((C > 0.1) & (C < 0.9)),
+                          'within_consensus': within.mean() if within.size else np.nan,
+                          'min_item_consensus': np.nanmin(item) if np.any(~np.isnan(item)) else np.nan})
+    stability = pd.DataFrame(stability).set_index('n_clusters') if stability else pd.DataFrame()
+    best_k = int(stability['pac'].idxmin()) if len(stability) else None
+    return ConsensusResult(pd.DataFrame(labels, index=index), stability,
+                           pd.DataFrame(item_consensus, index=index), consensus, best_k)
+
+@_profiled
+def pathway_consensus(adata, pathway_genes, range_n_clusters=None, name=None, norm=False, **kwargs):
+    '''Consensus clustering of the Leiden clusters on a pathway, the stable
+    alternative to picking num_clust from silhouette_plots and cutting the
+    single-linkage tree in heatmap.
+    
+    Input:
+    adata : AnnData object
+    pathway_genes : a list of the genes in the pathway
+    range_n_clusters : numbers of clusters, 2 to (number of Leiden clusters - 1)
+                       by default
+    name : if given, the labels of the most stable k are stored as the
+           pathway clustering name (see store_pathway_labels)
+    norm : whether or not to use normalized data. z-score is default.
+    **kwargs : passed to consensus_clustering
+    
+    Output:
+    ConsensusResult, indexed by the Leiden clusters
+    '''
+    df, _ = pathway_linkage(adata, pathway_genes, norm)
+    if range_n_clusters is None:
+        range_n_clusters = range(2, df.shape[1])
+    result = consensus_clustering(df.T.values.astype(float), range_n_clusters,
+                                  index=df.columns, **kwargs)
+    if name is not None and result.best_k is not None:
+        store_pathway_labels(adata, name, result.labels[result.best_k].astype(str))
+    return result
+
+# Pathway cluster labels of the cells are stored as small integer codes in
+# one compact label matrix, adata.obsm['pathway_clusters'] (cells x
+# pathways). The column names and the categories of every column are kept in
+# adata.uns['pathway_clusters']. The codes are derived from the Leiden codes
+# through a lookup array, so no per-cell string replacement is needed.
+
+def _code_dtype(n_categories):
+    return np.int8 if n_categories < 128 else np.int16
+
+def store_pathway_labels(adata, name, cluster_labels, partition_key = 'leiden'):
+    '''Stores the pathway cluster of every cell in the label matrix.
+    
+    Input:
+    adata : AnnData object
+    name : the name of the pathway clustering (column of the label matrix)
+    cluster_labels : pandas Series with the pathway cluster of each Leiden
+                     cluster (as returned by pathway_clusters)
+    
+    Output:
+    the integer codes of the cells, -1 for cells without a cluster
+    '''
+    categories = sorted(pd.unique(cluster_labels), key=lambda c: (len(str(c)), str(c)))
+    lookup = pd.Index(categories).get_indexer(
+        cluster_labels.reindex(adata.obs[partition_key].cat.categories))
+    # The last entry maps the Leiden code -1 (no cluster) to -1
+    lookup = np.append(lookup, -1).astype(_code_dtype(len(categories)))
+    codes = lookup[adata.obs[partition_key].cat.codes.values]
+
+    info = adata.uns.get('pathway_clusters', {'names': [], 'categories': {}})
+    names = list(info['names'])
+    matrix = adata.obsm['pathway_clusters'] if 'pathway_clusters' in adata.obsm else None
+    if matrix is None or matrix.shape[0] != adata.n_obs:
+        matrix, names = np.empty((adata.n_obs, 0), dtype=codes.dtype), []
+    dtype = np.promote_types(matrix.dtype, codes.dtype)
+    if name in names:
+        matrix = matrix.astype(dtype, copy=False)
+        matrix[:, names.index(name)] = codes
+    else:
+        matrix = np.hstack([matrix.astype(dtype, copy=False), codes[:, None].astype(dtype)])
+        names.append(name)
+    adata.obsm['pathway_clusters'] = matrix
+    categories_dict = dict(info['categories'])
+    categories_dict[name] = [str(c) for c in categories]
+    adata.uns['pathway_clusters'] = {'names': names, 'categories': categories_dict}
+    return codes
+
+def pathway_labels(adata, name):
+    '''The pathway cluster labels of the cells for the clustering name as a
+    categorical Series (the string view of the label matrix).'''
+    info = adata.uns['pathway_clusters']
+    codes = adata.obsm['pathway_clusters'][:, list(info['names']).index(name)]
+    return pd.Series(pd.Categorical.from_codes(codes, info['categories'][name]),
+                     index=adata.obs_names, name=name)
+
+@_profiled
 def heatmap(adata, pathway_genes, num_clust, name, norm = False,
-                     leg_axes = (1.3, 1.3), leg_cols = 1):
+                     leg_axes = (1.3, 1.3), leg_cols = 1, store_obs = False):
     '''We group the leiden clusters based on similarity of expression of 
     specific genes in a pathway. 
     
@@ -472,6 +1827,14 @@ def heatmap(adata, pathway_genes, num_clust, name, norm = False,
     cosine distance
     name : the name with which we want to label the clusters of this pathway
     leg_axes : we can change the coordinates of the legend
+    store_obs : also put the labels in adata.obs[name] (as a categorical) so
+    that they can be used for coloring plots. Off by default: the labels are
+    always stored in adata.obsm['pathway_clusters'] and pathway_labels builds
+    the categorical view when needed, e.g.
+    adata.obs[name] = pathway_labels(adata, name).
+    
+    The linkage tree is cached (see pathway_linkage), so calling heatmap again
+    with a different num_clust only cuts the existing tree.
     
     Returns: 
     
@@ -479,28 +1842,16 @@ def heatmap(adata, pathway_genes, num_clust, name, norm = False,
     Return at Index 0: Clustermap Figure you can later save
     Return at Index 1: A dataframe of all the gene expression values
     '''
-    if norm:
-        df = gene_expression_norm(adata, pathway_genes)
-    else:
-        df = gene_expression(adata, pathway_genes)
-    d = sch.distance.pdist(df.transpose(), metric='cosine')
-    L=sch.linkage(d)
-    linkage = sch.fcluster(L, num_clust,'maxclust')
-    str_linkage = []
-    for i in linkage:
-        str_linkage.append(str(i))
-    new_dict = dict(zip([str(i) for i in range(0,len(str_linkage))], str_linkage))
-    adata.obs[name] = adata.obs['leiden'].replace(new_dict)
-    if norm:
-        df = gene_expression_norm(adata, pathway_genes)
-    else:
-        df = gene_expression(adata, pathway_genes)
-    cols = {}
-    for j in list(df.columns):
-        cols[j] = str(adata[adata.obs['leiden'] == j].obs[name][0])
-    cols=pd.Series(data=cols, name='Clusters')
-    labels = adata.obs[name].unique()
-    labels = list(map(str, labels))
+    df, L = pathway_linkage(adata, pathway_genes, norm)
+    cluster_labels = pathway_clusters(adata, pathway_genes, num_clust, norm)
+    codes = store_pathway_labels(adata, name, cluster_labels)
+    if store_obs:
+        adata.obs[name] = pathway_labels(adata, name)
+    cols = cluster_labels.rename('Clusters')
+    # Labels in order of their first appearance among the cells
+    categories = adata.uns['pathway_clusters']['categories'][name]
+    present, first = np.unique(codes[codes >= 0], return_index=True)
+    labels = [categories[c] for c in present[np.argsort(first)]]
     cmap = plt.get_cmap('Paired')
     colors = cmap(np.linspace(0, 1, len(labels)))
     lut1 = dict(zip(labels, colors))
@@ -511,9 +1862,13 @@ def heatmap(adata, pathway_genes, num_clust, name, norm = False,
         cols_to_return.append(lut1[k])
     adata.uns[name+'_colors'] = cols_to_return
     row_colors1 = cols.map(lut1)
-    g = sns.clustermap(df, metric='cosine', row_cluster=False, cmap='viridis',
-                      col_linkage=L, col_colors=row_colors1,figsize=(6,6));
+    # The column dendrogram is taken from the cached linkage, so seaborn
+    # does not recompute the cosine distances.
+    with _stage('clustermap'):
+        g = sns.clustermap(df, row_cluster=False, cmap='viridis',
+                          col_linkage=L, col_colors=row_colors1,figsize=(6,6));
     ax = g.ax_heatmap
+    from matplotlib.lines import Line2D
     legend_elements=[]
     keys= list(lut1.keys())
     keys.sort()
@@ -527,32 +1882,40 @@ def heatmap(adata, pathway_genes, num_clust, name, norm = False,
     ax.set_xlabel('Leiden clustering', x=0.5)
     return g.fig, df
 
-def exp_across_clusters(df):
+@_profiled
+def exp_across_clusters(df, plot=True):
     '''Plots a bar chart of expression summed across different Leiden clusters.
     This is useful to visualize which clusters we can remove from our heatmaps.
     
     Input: A dataframe whose rows are different genes, and whose columns are the Leiden
-    cluster labels.
+    cluster labels. If plot is False the sums are returned without plotting.
     
     Output: a bar chart with the total expression for each cluster.'''
     
     cols = df.sum(axis=0)
+    if not plot:
+        return cols
     return cols.plot.bar(title='Z-Score Expression Sum Across Leiden Clusters');
 
-def exp_across_genes(df):
+@_profiled
+def exp_across_genes(df, plot=True):
     '''Plots a bar chart of expression summed across different genes.
     This is useful to visualize which genes we can remove from our heatmaps.
     
     Input: 
     df: A dataframe whose rows are different genes, and whose columns are the Leiden
     cluster labels.
+    plot: if False the sums are returned without plotting.
     
     Output: a bar chart with the total expression for each cluster.'''
     
     rows = df.sum(axis=1)
+    if not plot:
+        return rows
     return rows.plot.bar(title='Z-Score Expression Sum Across Genes');
 
-def exp_above_threshold(df, axis, threshold):
+@_profiled
+def exp_above_threshold(df, axis, threshold, plot=True):
     '''This function visualizes counts of gene expression above a certain threshold.
     Inputs: 
     
@@ -560,12 +1923,1058 @@ def exp_above_threshold(df, axis, threshold):
     cluster labels.
     axis: 0=rows, 1=columns
     threshold: define a threshold value for gene expression.
+    plot: if False the counts are returned without plotting.
     
     Output: a bar chart
     '''
-    ax = df.iloc[:,:].ge(threshold).sum(axis).plot.bar(
+    counts = df.iloc[:,:].ge(threshold).sum(axis)
+    if not plot:
+        return counts
+    ax = counts.plot.bar(
         title=('Histogram of Counts Above Threshold Value'))
     ax.set_xlabel('Sum along axis '+ str(axis))
     ax.set_ylabel('Counts Above Threshold Value')
     return ax
 
+# Vectorized versions of the exp_* summaries over a stack of result tables
+# (e.g. pathway x resolution x dataset). The tables are aligned into one 3-D
+# array of slices x genes x clusters, padded with NaN, and every summary is
+# computed for all slices in one call. Plotting is a separate step.
+
+ResultCube = collections.namedtuple('ResultCube', ['values', 'slices', 'genes', 'clusters'])
+
+def result_cube(tables):
+    '''Stacks genes x clusters tables into a ResultCube.
+    
+    Input:
+    tables : dictionary {slice key: DataFrame}, e.g. keyed by (pathway,
+             resolution), or a DataFrame with (slice, gene) rows like the
+             expression table of pathway_batch
+    
+    Output:
+    ResultCube with values (slices x genes x clusters, float, NaN where a
+    table has no such gene or cluster) and the slice, gene and cluster labels
+    '''
+    if isinstance(tables, pd.DataFrame):
+        tables = {key: df.droplevel(0) for key, df in tables.groupby(level=0, sort=False)}
+    slices = list(tables.keys())
+    genes = pd.Index(pd.unique(np.concatenate([np.asarray(df.index, dtype=object)
+                                               for df in tables.values()])))
+    clusters = pd.Index(pd.unique(np.concatenate([np.asarray(df.columns, dtype=object)
+                                                  for df in tables.values()])))
+    values = np.full((len(slices), len(genes), len(clusters)), np.nan)
+    for i, df in enumerate(tables.values()):
+        rows = genes.get_indexer(np.asarray(df.index, dtype=object))
+        cols = clusters.get_indexer(np.asarray(df.columns, dtype=object))
+        values[i][np.ix_(rows, cols)] = df.values.astype(float)
+    return ResultCube(values, slices, genes, clusters)
+
+def _slice_index(cube):
+    if cube.slices and all(isinstance(k, tuple) for k in cube.slices):
+        return pd.MultiIndex.from_tuples(cube.slices)
+    return pd.Index(cube.slices)
+
+@_profiled
+def cube_across_clusters(cube):
+    '''Expression summed across genes for every cluster of every slice
+    (exp_across_clusters for all slices). Output: slices x clusters table.'''
+    return pd.DataFrame(np.nansum(cube.values, axis=1), index=_slice_index(cube),
+                        columns=cube.clusters)
+
+@_profiled
+def cube_across_genes(cube):
+    '''Expression summed across clusters for every gene of every slice
+    (exp_across_genes for all slices). Output: slices x genes table.'''
+    return pd.DataFrame(np.nansum(cube.values, axis=2), index=_slice_index(cube),
+                        columns=cube.genes)
+
+@_profiled
+def cube_above_threshold(cube, axis, threshold):
+    '''Counts of values above (or equal to) threshold, like
+    exp_above_threshold, for all slices at once.
+    
+    Input:
+    cube : ResultCube
+    axis : 0 counts over the genes (one count per cluster), 1 counts over the
+           clusters (one count per gene)
+    threshold : a number, or an array of thresholds to evaluate at once
+    
+    Output:
+    slices x clusters (axis 0) or slices x genes (axis 1) table of counts.
+    For an array of thresholds the rows are indexed by (threshold, slice),
+    e.g. table.loc[0.5] is the table of the threshold 0.5.
+    '''
+    labels = cube.clusters if axis == 0 else cube.genes
+    if np.ndim(threshold) == 0:
+        with np.errstate(invalid='ignore'):
+            counts = (cube.values >= threshold).sum(axis=axis + 1)
+        return pd.DataFrame(counts, index=_slice_index(cube), columns=labels)
+    # Every value is binned once against the sorted thresholds; a value
+    # counts for all the thresholds below its bin, so a reversed cumulative
+    # sum of the per-line bin histograms gives the counts for all thresholds.
+    threshold = np.asarray(threshold, dtype=float)
+    order = np.argsort(threshold)
+    moved = np.moveaxis(cube.values, axis + 1, -1)
+    lines = moved.reshape(-1, moved.shape[-1])
+    n_lines, n_thresholds = lines.shape[0], len(threshold)
+    bins = np.searchsorted(threshold[order], np.where(np.isnan(lines), -np.inf, lines), side='right')
+    bins += np.arange(n_lines)[:, None] * (n_thresholds + 1)
+    hist = np.bincount(bins.ravel(), minlength=n_lines * (n_thresholds + 1))
+    above = hist.reshape(n_lines, n_thresholds + 1)[:, ::-1].cumsum(1)[:, ::-1]
+    counts = np.empty((n_lines, n_thresholds), dtype=np.int64)
+    counts[:, order] = above[:, 1:]
+    counts = counts.T.reshape(n_thresholds * len(cube.slices), len(labels))
+    slices = [k if isinstance(k, tuple) else (k,) for k in cube.slices]
+    index = pd.MultiIndex.from_tuples([(t,) + k for t in threshold for k in slices])
+    index = index.set_names(['threshold'] + [None] * (index.nlevels - 1))
+    return pd.DataFrame(counts, index=index, columns=labels)
+
+def plot_summary(table, key, title = None, ax = None):
+    '''Bar chart of one slice of a cube_* summary table.'''
+    row = table.loc[key]
+    return row.plot.bar(title=title if title is not None else str(key), ax=ax)
+
+
+# Cell-level pathway activity scores. The pathway lists are turned into one
+# sparse genes x pathways weight matrix and all the scores come from a single
+# sparse product X @ W. The control-gene background of sc.tl.score_genes is
+# folded into the same matrix as negative weights.
+
+def pathway_weights(var_names, pathway_dict, gene_means=None, ctrl_size=50, n_bins=25, seed=0):
+    '''Builds the genes x pathways weight matrix of pathway_scores.
+    
+    Input:
+    var_names : the gene names
+    pathway_dict : dictionary {pathway name: list of genes}
+    gene_means : mean expression of every gene; if given, control genes are
+                 sampled from the same expression bins as the pathway genes
+                 (like sc.tl.score_genes) and get negative weights
+    ctrl_size : number of control genes sampled per pathway gene
+    n_bins : number of expression bins
+    seed : seed of the control gene sampling
+    
+    Output:
+    CSC matrix (genes x pathways) whose columns average the pathway genes
+    (minus the average of their control genes)
+    '''
+    var_names = pd.Index(var_names)
+    rng = np.random.default_rng(seed)
+    if gene_means is not None:
+        ranks = pd.Series(gene_means).rank(method='min').values
+        n_items = max(1, int(np.round(len(ranks) / (n_bins - 1))))
+        cuts = (ranks // n_items).astype(int)
+        bins = pd.Series(np.arange(len(cuts))).groupby(cuts).apply(lambda g: g.values).to_dict()
+    rows, cols, weights = [], [], []
+    for j, genes in enumerate(pathway_dict.values()):
+        idx = np.unique(var_names.get_indexer(list(genes)))
+        idx = idx[idx >= 0]
+        if not len(idx):
+            continue
+        rows.append(idx)
+        cols.append(np.full(len(idx), j))
+        weights.append(np.full(len(idx), 1.0 / len(idx)))
+        if gene_means is not None:
+            control = set()
+            for cut in cuts[idx]:
+                pool = bins[cut]
+                control.update(rng.choice(pool, size=min(ctrl_size, len(pool)), replace=False))
+            control = np.array(sorted(control - set(idx)), dtype=int)
+            if len(control):
+                rows.append(control)
+                cols.append(np.full(len(control), j))
+                weights.append(np.full(len(control), -1.0 / len(control)))
+    if not rows:
+        return sp.csc_matrix((len(var_names), len(pathway_dict)))
+    return sp.csc_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                         shape=(len(var_names), len(pathway_dict)))
+
+@_profiled
+def pathway_scores(adata, pathway_dict=None, background=True, use_raw=False, key='pathway_scores',
+                   ctrl_size=50, n_bins=25, seed=0):
+    '''Per-cell activity scores of all the pathways at once, e.g. for UMAP
+    or trajectory overlays.
+    
+    Input:
+    adata : AnnData object
+    pathway_dict : dictionary {pathway name: list of genes}, the module
+                   pathways (wnts, wntr, bmps, bmpr, notch) by default
+    background : subtract the average of control genes with matching
+                 expression, like sc.tl.score_genes
+    use_raw : score the normalized data in adata.raw instead of adata.X
+    key : the scores are stored as a float32 cells x pathways array in
+          adata.obsm[key], the pathway names in adata.uns[key + '_names']
+    
+    Output:
+    DataFrame of the scores (cells x pathways)
+    '''
+    if pathway_dict is None:
+        pathway_dict = pathways
+    data = adata.raw if use_raw else adata
+    gene_means = _column_moments(data.X)[0] if background else None
+    W = pathway_weights(data.var_names, pathway_dict, gene_means, ctrl_size, n_bins, seed)
+    with _stage('product'):
+        scores = data.X @ W
+        scores = scores.toarray() if sp.issparse(scores) else np.asarray(scores)
+    adata.obsm[key] = scores.astype(np.float32)
+    adata.uns[key + '_names'] = list(pathway_dict.keys())
+    return pd.DataFrame(adata.obsm[key], index=adata.obs_names, columns=list(pathway_dict.keys()))
+
+# Report building. Finished figures are pickled and handed to a separate
+# writer process that renders them (into one PdfPages file or one file per
+# figure) while the next stage computes. matplotlib is not thread-safe (font
+# caches, rcParams and text layout are shared), so rendering happens in
+# another process, not in a thread. Figures are closed once pickled and the
+# queue is bounded, so memory stays bounded.
+
+def _figure_of(result):
+    '''The figure in the return value of vis_pre_processing,
+    vis_post_processing, silhouette_plots, heatmap or the exp_* functions.'''
+    if isinstance(result, tuple):
+        result = result[0]
+    if hasattr(result, 'savefig'):
+        return result
+    if hasattr(result, 'figure'):
+        return result.figure
+    raise TypeError('no figure found in %r' % type(result))
+
+def _report_worker(path, single_file, format, savefig_kwargs, figures, results):
+    '''Writer process of ReportWriter: renders the pickled figures it
+    receives until None, and reports every written file (or the error) on
+    results, then None when done.'''
+    pdf = None
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        if single_file:
+            from matplotlib.backends.backend_pdf import PdfPages
+            pdf = PdfPages(path)
+        while True:
+            item = figures.get()
+            if item is None:
+                break
+            data, name = item
+            fig = pickle.loads(data)
+            if pdf is not None:
+                pdf.savefig(fig, **savefig_kwargs)
+                results.put(name)
+            else:
+                target = os.path.join(path, name + '.' + format)
+                fig.savefig(target, format=format, **savefig_kwargs)
+                results.put(target)
+            del fig, data, item
+    except Exception as e:
+        # Not every exception can be pickled back
+        results.put(RuntimeError('writing the report failed: %r' % (e,)))
+        # Keep draining so that add() never blocks on a dead writer
+        while figures.get() is not None:
+            pass
+    finally:
+        if pdf is not None:
+            pdf.close()
+        results.put(None)
+
+class ReportWriter(object):
+    '''Writes figures in a background process.
+    
+    Input:
+    path : a .pdf file to collect all the figures in (with PdfPages), or a
+           directory to write one file per figure in
+    single_file : whether path is one PdfPages file or a directory
+    max_pending : how many figures can wait to be written before add blocks
+    format : file format of the per-figure files
+    **savefig_kwargs : passed to savefig
+    
+    The figures are pickled, so they should not hold unpicklable objects
+    (e.g. lambdas as formatters).
+    
+    Usage:
+    with ReportWriter('report.pdf') as report:
+        report.add(vis_pre_processing(adata), 'qc')
+        fig, scores = report.add(silhouette_plots(adata, 'Notch', notch))
+    '''
+    def __init__(self, path, single_file=True, max_pending=4, format='pdf', **savefig_kwargs):
+        self.path = path
+        self.single_file = single_file
+        self.format = format
+        self.savefig_kwargs = savefig_kwargs
+        self.error = None
+        self.written = []
+        self._count = 0
+        self._closed = False
+        if not single_file:
+            os.makedirs(path, exist_ok=True)
+        # spawn: the writer does not inherit the threads and pyplot state of
+        # this process
+        context = multiprocessing.get_context('spawn')
+        self._figures = context.Queue(maxsize=max_pending)
+        self._results = context.Queue()
+        self._process = context.Process(target=_report_worker, name='ReportWriter', daemon=True,
+                                        args=(path, single_file, format, savefig_kwargs,
+                                              self._figures, self._results))
+        self._process.start()
+
+    def _collect(self, block=False):
+        '''Takes the written files and errors reported so far by the writer,
+        or all of them until its final None if block. Returns False once the
+        writer is done (or gone).'''
+        while True:
+            try:
+                item = self._results.get(block, timeout=1 if block else None)
+            except queue.Empty:
+                if block and self._process.is_alive():
+                    continue
+                return not block
+            if item is None:
+                return False
+            if item is None:
+                return False
+            if isinstance(item, Exception):
+                self.error = item
+            else:
+                self.written.append(item)
+
+    def add(self, result, name=None):
+        '''Queues the figure of result (a figure, axes, or the return value of
+        one of the plotting functions) to be written, and returns result.'''
+        if self._closed:
+            raise ValueError('the report is closed')
+        self._collect()
+        if self.error is not None:
+            raise self.error
+        fig = _figure_of(result)
+        self._count += 1
+        if name is None:
+            name = 'figure_%03d' % self._count
+        # Detach the figure from pyplot and pickle it in this thread, the
+        # queue only sends bytes
+        plt.close(fig)
+        with _stage('pickle_figure'):
+            data = pickle.dumps(fig, protocol=pickle.HIGHEST_PROTOCOL)
+        self._figures.put((data, name))
+        return result
+
+    def close(self):
+        '''Waits until all the queued figures are written.'''
+        if not self._closed:
+            self._closed = True
+            self._figures.put(None)
+            self._collect(block=True)
+            self._process.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+# Nearest-neighbour index over cluster expression profiles (the columns of
+# the gene_expression tables), to find e.g. the clusters of dataset B that
+# are most like cluster 5 of dataset A for the Notch pathway. Profiles are
+# normalized so that cosine and correlation distances become inner products.
+# Small indexes are searched exactly; larger ones use random-hyperplane LSH
+# tables, which support incremental insertion, and rerank the candidates.
+
+class ClusterIndex(object):
+    '''Nearest-neighbour index of cluster profiles over a fixed list of genes.
+    
+    Input:
+    genes : the genes (features) of the profiles, e.g. a pathway list
+    metric : 'cosine' or 'correlation'
+    n_tables, n_bits : number of LSH tables and of hyperplanes per table
+    exact_threshold : indexes with at most this many profiles are always
+                      searched exactly
+    seed : seed of the hyperplanes
+    '''
+    def __init__(self, genes, metric='cosine', n_tables=8, n_bits=10, exact_threshold=2000, seed=0):
+        if metric not in ('cosine', 'correlation'):
+            raise ValueError("metric should be 'cosine' or 'correlation'")
+        self.genes = pd.Index(genes)
+        self.metric = metric
+        self.exact_threshold = exact_threshold
+        self.seed = seed
+        self.planes = np.random.default_rng(seed).standard_normal(
+            (n_tables, n_bits, len(self.genes))).astype(np.float32)
+        self._vectors = np.empty((0, len(self.genes)), dtype=np.float32)
+        self._size = 0
+        self.labels = []
+        # Id of every (dataset, cluster) label and dataset code of every id,
+        # so that lookups and dataset filters do not scan the labels
+        self._ids = {}
+        self._dataset_codes = {}
+        self._codes = np.empty(0, dtype=np.int32)
+        self._tables = [collections.defaultdict(list) for _ in range(n_tables)]
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def vectors(self):
+        return self._vectors[:self._size]
+
+    def _normalize(self, X):
+        X = np.nan_to_num(np.asarray(X, dtype=np.float64))
+        if self.metric == 'correlation':
+            X = X - X.mean(1, keepdims=True)
+        norms = np.linalg.norm(X, axis=1, keepdims=True)
+        return (X / np.where(norms == 0, 1, norms)).astype(np.float32)
+
+    def _register(self, labels):
+        '''Appends (dataset, cluster) labels for the next ids.'''
+        start = len(self.labels)
+        if start + len(labels) > len(self._codes):
+            grown = np.empty(max(2 * len(self._codes), start + len(labels)), dtype=np.int32)
+            grown[:start] = self._codes[:start]
+            self._codes = grown
+        for i, label in enumerate(labels, start):
+            self._ids.setdefault(label, i)
+            self._codes[i] = self._dataset_codes.setdefault(label[0], len(self._dataset_codes))
+        self.labels.extend(labels)
+
+    def _dataset_mask(self, ids, datasets, exclude_dataset):
+        '''Which of ids belong to one of datasets and not to exclude_dataset.'''
+        codes = self._codes[ids]
+        keep = np.ones(len(ids), dtype=bool)
+        if datasets is not None:
+            allowed = [self._dataset_codes[d] for d in map(str, datasets) if d in self._dataset_codes]
+            keep &= np.isin(codes, allowed)
+        if exclude_dataset is not None and str(exclude_dataset) in self._dataset_codes:
+            keep &= codes != self._dataset_codes[str(exclude_dataset)]
+        return keep
+
+    def _hashes(self, X):
+        '''LSH codes of the rows of X, one int per table (tables x rows).'''
+        bits = np.einsum('tbg,ng->tnb', self.planes, X) > 0
+        return bits.dot(1 << np.arange(bits.shape[-1]))
+
+    def add(self, df, dataset):
+        '''Adds the clusters (columns) of a genes x clusters table, e.g. the
+        output of gene_expression, under the name dataset. Genes of the index
+        missing from df count as 0.'''
+        X = self._normalize(df.reindex(self.genes).T.values)
+        n = X.shape[0]
+        if self._size + n > len(self._vectors):
+            grown = np.empty((max(2 * len(self._vectors), self._size + n), len(self.genes)),
+                             dtype=np.float32)
+            grown[:self._size] = self.vectors
+            self._vectors = grown
+        self._vectors[self._size:self._size + n] = X
+        ids = np.arange(self._size, self._size + n)
+        for table, codes in zip(self._tables, self._hashes(X)):
+            for i, code in zip(ids, codes):
+                table[int(code)].append(int(i))
+        self._size += n
+        self._register([(str(dataset), str(c)) for c in df.columns])
+        return self
+
+    def _candidates(self, q):
+        '''Ids in the buckets of q and in the buckets one bit away.'''
+        found = set()
+        n_bits = self.planes.shape[1]
+        for table, code in zip(self._tables, self._hashes(q[None, :])[:, 0]):
+            code = int(code)
+            found.update(table.get(code, ()))
+            for b in range(n_bits):
+                found.update(table.get(code ^ (1 << b), ()))
+        return np.fromiter(found, dtype=np.int64, count=len(found))
+
+    def query(self, profile, k=5, datasets=None, exclude_dataset=None, exact=None):
+        '''The k clusters closest to profile.
+        
+        Input:
+        profile : a (dataset, cluster) pair already in the index, or a
+                  Series of expression values indexed by gene
+        k : number of neighbours
+        datasets : only return clusters of these datasets
+        exclude_dataset : do not return clusters of this dataset
+        exact : force an exact (True) or approximate (False) search, by
+                default exact for indexes up to exact_threshold profiles
+        
+        Output:
+        DataFrame with the dataset, cluster and distance of the neighbours
+        '''
+        if isinstance(profile, tuple):
+            q = self.vectors[self._ids[(str(profile[0]), str(profile[1]))]]
+        else:
+            q = self._normalize(pd.Series(profile).reindex(self.genes).values[None, :])[0]
+        if exact is None:
+            exact = self._size <= self.exact_threshold
+        ids = np.arange(self._size) if exact else self._candidates(q)
+        if datasets is not None or exclude_dataset is not None:
+            ids = ids[self._dataset_mask(ids, datasets, exclude_dataset)]
+        if not exact and len(ids) < k:
+            return self.query(profile, k, datasets, exclude_dataset, exact=True)
+        distances = 1 - self.vectors[ids] @ q
+        best = np.argsort(distances, kind='stable')[:k]
+        return pd.DataFrame({'dataset': [self.labels[i][0] for i in ids[best]],
+                             'cluster': [self.labels[i][1] for i in ids[best]],
+                             'distance': distances[best]})
+
+    def save(self, path):
+        '''Writes the index to a .npz file (the LSH tables are rebuilt on load).'''
+        with open(path, 'wb') as f:
+            np.savez(f, vectors=self.vectors, planes=self.planes,
+                     genes=np.asarray(self.genes, dtype=str),
+                     labels=np.asarray(self.labels, dtype=str).reshape(-1, 2),
+                     params=np.array([self.metric, self.exact_threshold, self.seed], dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            metric, exact_threshold, seed = f['params']
+            index = cls(f['genes'], metric=str(metric), n_tables=f['planes'].shape[0],
+                        n_bits=f['planes'].shape[1], exact_threshold=int(exact_threshold),
+                        seed=int(seed))
+            index.planes = f['planes']
+            vectors, labels = f['vectors'], f['labels']
+        index._vectors = np.array(vectors, dtype=np.float32)
+        index._size = len(vectors)
+        index._register([tuple(l) for l in labels])
+        for table, codes in zip(index._tables, index._hashes(index.vectors)):
+            for i, code in enumerate(codes):
+                table[int(code)].append(i)
+        return index
+
+@_profiled
+def build_cluster_index(datasets, pathway_genes, norm=False, metric='cosine', index=None, **kwargs):
+    '''Builds (or extends) a ClusterIndex of the Leiden cluster profiles of
+    several datasets for one pathway.
+    
+    Input:
+    datasets : dictionary {name: AnnData}
+    pathway_genes : a list of the genes in the pathway
+    norm : whether or not to use normalized data. z-score is default.
+    metric : 'cosine' or 'correlation'
+    index : an existing index to add the datasets to
+    **kwargs : passed to ClusterIndex
+    
+    Output:
+    ClusterIndex
+    '''
+    if index is None:
+        index = ClusterIndex(pathway_genes, metric=metric, **kwargs)
+    for name, adata in datasets.items():
+        df, _ = pathway_linkage(adata, pathway_genes, norm)
+        index.add(df, name)
+    return index
+
+# Batch mode: the pathway stages (expression tables, silhouette scores and
+# the heatmap clustering) run for many datasets, e.g. one per organ, in
+# parallel processes. The results are stacked into tables aligned over the
+# union of the pathway genes found in any of the datasets.
+
+def _split_datasets(datasets, group_key):
+    '''Yields (name, AnnData) pairs from a dictionary or list of AnnData
+    objects, or from one AnnData object split by adata.obs[group_key].'''
+    if hasattr(datasets, 'obs'):
+        if group_key is None:
+            yield 'all', datasets
+            return
+        groups = datasets.obs[group_key]
+        for name in pd.unique(groups):
+            yield str(name), datasets[(groups == name).values].copy()
+    elif isinstance(datasets, dict):
+        for name, adata in datasets.items():
+            yield str(name), adata
+    else:
+        for i, adata in enumerate(datasets):
+            yield str(i), adata
+
+def _batch_worker(name, adata, pathway_dict, norm, num_clust, partition_key, silhouette):
+    '''Runs the pathway stages on one dataset. Module level so that it can be
+    sent to worker processes. Works on a shallow copy of adata (X, var and
+    raw are shared, obs is copied), so the obs columns the stages add do not
+    change the caller's object, whether the worker runs in-process or not.'''
+    adata = ad.AnnData(adata.X, obs=adata.obs.copy(), var=adata.var, raw=adata.raw)
+    adata.obs[partition_key] = adata.obs[partition_key].astype('category')
+    adata.obs[partition_key] = adata.obs[partition_key].cat.remove_unused_categories()
+    n_leiden = len(adata.obs[partition_key].cat.categories)
+    expression, scores, labels = {}, {}, {}
+    for pathway, genes in pathway_dict.items():
+        if n_leiden < 2:
+            break
+        df, L = pathway_linkage(adata, genes, norm, partition_key)
+        if df.empty:
+            continue
+        expression[pathway] = df
+        if silhouette and n_leiden > 2:
+            # Already in a batch worker, so the trials run in this process
+            score = silhouette_analysis(range(2, n_leiden), df.T.values.astype(float), n_jobs=1)
+            scores[pathway] = pd.Series([np.mean(s[1]) for s in score],
+                                        index=[s[0] for s in score])
+        k = num_clust.get(pathway) if isinstance(num_clust, dict) else num_clust
+        if k:
+            labels[pathway] = pathway_clusters(adata, genes, k, norm, partition_key)
+    return name, expression, scores, labels
+
+@_profiled
+def pathway_batch(datasets, pathway_dict = None, group_key = None, norm = False,
+                  num_clust = None, partition_key = 'leiden', silhouette = True, n_jobs = None):
+    '''Runs the pathway expression, silhouette and heatmap clustering stages
+    for many datasets in parallel processes.
+    
+    Input:
+    datasets : a dictionary {name: AnnData}, a list of AnnData objects, or
+               one AnnData object that is split by adata.obs[group_key]
+    pathway_dict : dictionary {pathway name: list of genes}, the module
+                   pathways (wnts, wntr, bmps, bmpr, notch) by default
+    group_key : obs field to split one AnnData object by, e.g. 'Organ'
+    norm : whether or not to use normalized data. z-score is default.
+    num_clust : number of pathway clusters to cut the linkage tree into, an
+                int or a dictionary {pathway name: int}. None skips this stage
+    partition_key : the obs field with the Leiden clusters
+    silhouette : whether to run silhouette_analysis (the slowest stage)
+    n_jobs : number of worker processes, all cores by default
+    
+    Output:
+    expression : genes x clusters table with rows (pathway, gene) over the
+                 union of the pathway genes and columns (dataset, cluster).
+                 Genes missing from a dataset are NaN.
+    silhouettes : mean silhouette score with rows (dataset, pathway) and
+                  the number of clusters as columns
+    labels : pathway cluster of each Leiden cluster, rows (dataset, cluster)
+             and one column per pathway
+    '''
+    if pathway_dict is None:
+        pathway_dict = pathways
+    n_jobs = _max_workers(n_jobs)
+    tasks = ((name, adata, pathway_dict, norm, num_clust, partition_key, silhouette)
+             for name, adata in _split_datasets(datasets, group_key))
+    results = _parallel_map(_batch_worker, tasks, n_jobs, 'processes')
+
+    blocks = []
+    for pathway in pathway_dict:
+        tables = {name: exp[pathway] for name, exp, _, _ in results if pathway in exp}
+        if not tables:
+            continue
+        genes = [g for g in pathway_dict[pathway]
+                 if any(g in df.index for df in tables.values())]
+        aligned = pd.concat({name: df.reindex(genes) for name, df in tables.items()}, axis=1)
+        blocks.append(pd.concat({pathway: aligned}))
+    expression = pd.DataFrame()
+    if blocks:
+        expression = pd.concat(blocks)
+        expression.index.names = ['pathway', 'gene']
+        expression.columns.names = ['dataset', 'cluster']
+
+    silhouettes = pd.DataFrame({(name, pathway): s for name, _, scores, _ in results
+                                for pathway, s in scores.items()}).T
+    if not silhouettes.empty:
+        silhouettes.index.names = ['dataset', 'pathway']
+        silhouettes.columns.name = 'n_clusters'
+
+    labels = pd.DataFrame()
+    label_tables = {name: pd.DataFrame(lab) for name, _, _, lab in results if lab}
+    if label_tables:
+        labels = pd.concat(label_tables)
+        labels.index.names = ['dataset', 'cluster']
+    return expression, silhouettes, labels
+
+# Checkpoints of the preprocessing stages. The key of a checkpoint hashes the
+# key of the stage input (or the data itself for the first stage), the code
+# of the stage function (bytecode, constants and defaults), its version in
+# _stage_versions and its parameters, so a change of a downstream parameter
+# only reruns the downstream stages. The code of the functions a stage calls
+# is not hashed: bump the version of the stage when one of them changes (or
+# clear cache_dir). The matrices are stored as .npy files and reopened
+# memory-mapped (copy-on-write), without deserialization.
+
+_checkpoint_format = 2
+_stage_versions = {'filter_data': 1, 'normalize_data': 1, 'select_genes': 1,
+                   'merge_genes': 1, 'scale_data': 1}
+
+def _hash_update(h, value):
+    if isinstance(value, np.ndarray):
+        h.update(str((value.dtype, value.shape)).encode())
+        h.update(memoryview(np.ascontiguousarray(value)).cast('B'))
+    else:
+        h.update(repr(value).encode())
+
+def dataset_fingerprint(adata):
+    '''A hash of the expression matrix, cell and gene names of adata, used
+    as the input key of the first checkpointed stage.'''
+    h = hashlib.sha256()
+    X = adata.X
+    if sp.issparse(X):
+        X = sp.csr_matrix(X)
+        for a in (X.data, X.indices, X.indptr):
+            _hash_update(h, a)
+    else:
+        _hash_update(h, np.asarray(X))
+    _hash_update(h, list(adata.obs_names))
+    _hash_update(h, list(adata.var_names))
+    _hash_update(h, sorted(adata.obs.columns.astype(str)))
+    return h.hexdigest()
+
+def _hash_code(h, code):
+    '''Hashes the bytecode and constants of code, including those of nested
+    functions (whose repr would contain their address).'''
+    h.update(code.co_code)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _hash_code(h, const)
+        elif isinstance(const, frozenset):
+            # Set literals have no stable order across runs
+            _hash_update(h, sorted(map(repr, const)))
+        else:
+            _hash_update(h, const)
+
+def _stage_key(input_key, stage, params):
+    fn = getattr(stage, '__wrapped__', stage)
+    h = hashlib.sha256()
+    _hash_update(h, input_key)
+    _hash_update(h, (fn.__name__, _checkpoint_format, _stage_versions.get(fn.__name__)))
+    # The stages compute in the precision of set_precision
+    _hash_update(h, np.dtype(_precision['dtype']).name)
+    _hash_code(h, fn.__code__)
+    _hash_update(h, (fn.__defaults__, fn.__kwdefaults__))
+    _hash_update(h, sorted(params.items()))
+    return h.hexdigest()[:32]
+
+def _save_matrix(X, path, prefix):
+    if sp.issparse(X):
+        X = sp.csr_matrix(X)
+        np.save(os.path.join(path, prefix + '_data.npy'), X.data)
+        np.save(os.path.join(path, prefix + '_indices.npy'), X.indices)
+        np.save(os.path.join(path, prefix + '_indptr.npy'), X.indptr)
+        return {'format': 'csr', 'shape': list(X.shape)}
+    np.save(os.path.join(path, prefix + '.npy'), np.asarray(X))
+    return {'format': 'dense', 'shape': list(X.shape)}
+
+def _load_matrix(path, prefix, meta):
+    load = lambda name: np.load(os.path.join(path, prefix + name), mmap_mode='c')
+    if meta['format'] == 'csr':
+        return sp.csr_matrix((load('_data.npy'), load('_indices.npy'), load('_indptr.npy')),
+                             shape=tuple(meta['shape']), copy=False)
+    return load('.npy')
+
+def _save_mapping(mapping, path, prefix, meta, annotations):
+    '''Saves the arrays and sparse matrices of mapping (obsm, varm, layers,
+    obsp, varp) as matrices, the other values go to the pickled annotations.'''
+    meta[prefix], annotations[prefix] = {}, {}
+    for key in mapping.keys():
+        value = mapping[key]
+        if isinstance(value, np.ndarray) or sp.issparse(value):
+            meta[prefix][key] = _save_matrix(value, path, prefix + '_' + key)
+        else:
+            annotations[prefix][key] = value
+
+def _load_mapping(mapping, path, prefix, meta, annotations):
+    for key, matrix_meta in meta[prefix].items():
+        mapping[key] = _load_matrix(path, prefix + '_' + key, matrix_meta)
+    for key, value in annotations[prefix].items():
+        mapping[key] = value
+
+def save_checkpoint(adata, path):
+    '''Writes adata to the checkpoint directory path: the matrices (X,
+    layers, obsm, varm, obsp, varp, and X and varm of raw) as .npy files,
+    the annotations pickled.'''
+    tmp = path + '.tmp' + str(os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    meta = {'X': _save_matrix(adata.X, tmp, 'X')}
+    annotations = {'obs': adata.obs, 'var': adata.var, 'uns': dict(adata.uns)}
+    for prefix in ('layers', 'obsm', 'varm', 'obsp', 'varp'):
+        _save_mapping(getattr(adata, prefix), tmp, prefix, meta, annotations)
+    if adata.raw is not None:
+        meta['raw'] = _save_matrix(adata.raw.X, tmp, 'raw_X')
+        annotations['raw_var'] = adata.raw.var
+        _save_mapping(adata.raw.varm, tmp, 'raw_varm', meta, annotations)
+    with open(os.path.join(tmp, 'annotations.pkl'), 'wb') as f:
+        pickle.dump(annotations, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+def load_checkpoint(path):
+    '''Reopens a checkpoint written by save_checkpoint. The matrices are
+    memory-mapped copy-on-write, so they are not read until used and the
+    checkpoint files are never modified.'''
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    with open(os.path.join(path, 'annotations.pkl'), 'rb') as f:
+        annotations = pickle.load(f)
+    adata = ad.AnnData(X=_load_matrix(path, 'X', meta['X']), obs=annotations['obs'],
+                       var=annotations['var'], uns=annotations['uns'])
+    for prefix in ('layers', 'obsm', 'varm', 'obsp', 'varp'):
+        _load_mapping(getattr(adata, prefix), path, prefix, meta, annotations)
+    if 'raw' in meta:
+        raw = ad.AnnData(X=_load_matrix(path, 'raw_X', meta['raw']),
+                         obs=pd.DataFrame(index=adata.obs_names),
+                         var=annotations['raw_var'])
+        _load_mapping(raw.varm, path, 'raw_varm', meta, annotations)
+        adata.raw = raw
+    return adata
+
+def checkpointed(stage, adata, cache_dir, input_key = None, **params):
+    '''Runs stage(adata, **params), or reopens its checkpoint if the same
+    stage already ran on the same input with the same parameters.
+    
+    Input:
+    stage : the stage function, e.g. filter_data
+    adata : the input AnnData object
+    cache_dir : directory of the checkpoints
+    input_key : key of the checkpoint adata was loaded from, None to hash
+                the data itself (see dataset_fingerprint)
+    **params : the parameters of the stage
+    
+    Output:
+    the output AnnData object and its checkpoint key (the input_key of the
+    next stage)
+    '''
+    if input_key is None:
+        input_key = dataset_fingerprint(adata)
+    key = _stage_key(input_key, stage, params)
+    path = os.path.join(cache_dir, getattr(stage, '__name__', 'stage') + '-' + key)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        with _stage('load_checkpoint'):
+            return load_checkpoint(path), key
+    result = stage(adata, **params)
+    if result is None:
+        result = adata
+    with _stage('save_checkpoint'):
+        os.makedirs(cache_dir, exist_ok=True)
+        save_checkpoint(result, path)
+    return result, key
+
+@_profiled
+def preprocess(adata, cache_dir, min_counts=2000, min_genes=2000, min_cells=3, target_sum=1e4,
+               min_mean=0.0125, max_mean=3, min_disp=0.5, all_genes=None, input_key=None):
+    '''Runs filter_data, normalize_data, select_genes and scale_data with a
+    checkpoint after every stage (see checkpointed). When only a downstream
+    parameter changes, the upstream stages are reopened from disk.
+    
+    Input:
+    adata : the raw count AnnData object
+    cache_dir : directory of the checkpoints
+    all_genes : list of lists of genes of interest for select_genes, the
+                module pathways by default
+    input_key : key identifying the raw input (e.g. a hash of the input
+                files), the data is hashed if None
+    
+    Output:
+    the scaled AnnData object
+    '''
+    if all_genes is None:
+        all_genes = [wnts, wntr, bmps, bmpr, notch]
+    all_genes = [list(genes) for genes in all_genes]
+    adata, key = checkpointed(filter_data, adata, cache_dir, input_key, min_counts=min_counts,
+                              min_genes=min_genes, min_cells=min_cells)
+    adata, key = checkpointed(normalize_data, adata, cache_dir, key, count=target_sum,
+                              highly_variable=False)
+    adata, key = checkpointed(select_genes, adata, cache_dir, key, all_genes=all_genes,
+                              min_mean=min_mean, max_mean=max_mean, min_disp=min_disp)
+    adata, key = checkpointed(scale_data, adata, cache_dir, key)
+    return adata
+
+# Fast ingest of the raw count inputs (.mtx with its genes/barcodes .tsv
+# tables, or a dense .tsv count table). Matrix Market files are split into
+# byte ranges that are parsed in parallel processes straight into
+# preallocated index/value arrays. The parsed matrix is cached in a binary
+# .npz file (next to the input or in cache_dir), which later runs load
+# directly.
+
+def _mtx_header(path):
+    '''Returns the Matrix Market field ('integer', 'real' or 'pattern'),
+    the shape and number of entries, and the byte offset of the entries.'''
+    with open(path, 'rb') as f:
+        banner = f.readline().decode().lower().split()
+        if len(banner) < 5 or banner[0] != '%%matrixmarket' or banner[2] != 'coordinate':
+            raise ValueError(path + ' is not a Matrix Market coordinate file')
+        line = f.readline()
+        while line.startswith(b'%') or not line.strip():
+            line = f.readline()
+        n_rows, n_cols, nnz = (int(v) for v in line.split())
+        return banner[3], (n_rows, n_cols), nnz, f.tell()
+
+def _parse_mtx_chunk(path, start, stop, pattern):
+    '''Parses the Matrix Market entries between two byte offsets (both at a
+    line start) into 0-based row and column indices and values.'''
+    with open(path, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(stop - start)
+    if not chunk.strip():
+        return (np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0, np.float32))
+    table = pd.read_csv(io.BytesIO(chunk), sep=r'\s+', header=None, comment='%',
+                        usecols=[0, 1] if pattern else [0, 1, 2]).values
+    rows = table[:, 0].astype(np.int32) - 1
+    cols = table[:, 1].astype(np.int32) - 1
+    values = np.ones(len(rows), np.float32) if pattern else table[:, 2].astype(np.float32)
+    return rows, cols, values
+
+def _line_offsets(path, start, end, n_chunks):
+    '''Byte offsets splitting [start, end) into about n_chunks ranges that
+    begin at line starts.'''
+    offsets = [start]
+    with open(path, 'rb') as f:
+        for i in range(1, n_chunks):
+            f.seek(max(start + (end - start) * i // n_chunks, offsets[-1]))
+            f.readline()
+            pos = f.tell()
+            if pos < end and pos > offsets[-1]:
+                offsets.append(pos)
+    offsets.append(end)
+    return offsets
+
+def _read_table_column(path, column = 0):
+    table = pd.read_csv(path, sep='\t', header=None, dtype=str)
+    return table[column].values if column < table.shape[1] else table[0].values
+
+def _npz_cache_path(path, cache_dir, options):
+    '''The .npz cache file of path: next to it or in cache_dir, with a hash
+    of the reading options (and of the absolute input paths) in its name, so
+    that reading the same input differently never reuses the cache.'''
+    digest = hashlib.sha1(repr(sorted(options.items())).encode()).hexdigest()[:12]
+    name = os.path.basename(path) + '.' + digest + '.npz'
+    return os.path.join(cache_dir or os.path.dirname(path), name)
+
+def _cache_valid(cache_path, sources):
+    if not os.path.exists(cache_path):
+        return False
+    stamp = os.path.getmtime(cache_path)
+    return all(os.path.getmtime(s) <= stamp for s in sources if s is not None)
+
+def _load_npz_counts(cache_path):
+    with np.load(cache_path, allow_pickle=False) as f:
+        X = sp.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        obs_names, var_names, gene_ids = f['obs_names'], f['var_names'], f['gene_ids']
+    var = pd.DataFrame({'gene_ids': gene_ids}, index=var_names) if len(gene_ids) \
+        else pd.DataFrame(index=var_names)
+    return ad.AnnData(X=X, obs=pd.DataFrame(index=obs_names), var=var)
+
+def _save_npz_counts(cache_path, adata):
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    X = sp.csr_matrix(adata.X)
+    gene_ids = adata.var['gene_ids'].values.astype(str) if 'gene_ids' in adata.var \
+        else np.array([], dtype=str)
+    with open(cache_path, 'wb') as f:
+        np.savez(f, data=X.data, indices=X.indices, indptr=X.indptr, shape=np.array(X.shape),
+                 obs_names=np.asarray(adata.obs_names, dtype=str),
+                 var_names=np.asarray(adata.var_names, dtype=str), gene_ids=gene_ids)
+
+@_profiled
+def read_mtx(path, genes = None, barcodes = None, cache = True, n_jobs = None,
+             chunk_bytes = 64 << 20, var_names = 'gene_symbols', cache_dir = None):
+    '''Reads a (genes x cells) Matrix Market count file, like 10x Genomics'
+    matrix.mtx, into a cells x genes AnnData object with a CSR matrix.
+    
+    Input:
+    path : the .mtx file
+    genes : genes/features .tsv file (gene IDs in the first column, symbols in
+            the second), by default genes.tsv or features.tsv next to path
+    barcodes : barcodes .tsv file, by default barcodes.tsv next to path
+    cache : write the parsed matrix to a .npz file and load it from there
+            while it is newer than the inputs. The file name is path plus a
+            hash of genes, barcodes and var_names.
+    n_jobs : number of parser processes, all cores by default
+    chunk_bytes : approximate size of the byte range parsed by one task
+    var_names : 'gene_symbols' or 'gene_ids', like sc.read_10x_mtx
+    cache_dir : directory of the cache file, the folder of path by default
+    
+    Output:
+    AnnData object (float32 counts) with obs_names from the barcodes and
+    var_names from the genes table (made unique)
+    '''
+    folder = os.path.dirname(path)
+    if genes is None:
+        genes = next((os.path.join(folder, g) for g in ('genes.tsv', 'features.tsv')
+                      if os.path.exists(os.path.join(folder, g))), None)
+    if barcodes is None and os.path.exists(os.path.join(folder, 'barcodes.tsv')):
+        barcodes = os.path.join(folder, 'barcodes.tsv')
+    cache_path = _npz_cache_path(path, cache_dir, {
+        'genes': genes and os.path.abspath(genes), 'barcodes': barcodes and os.path.abspath(barcodes),
+        'var_names': var_names})
+    if cache and _cache_valid(cache_path, [path, genes, barcodes]):
+        with _stage('load_cache'):
+            return _load_npz_counts(cache_path)
+
+    field, (n_genes, n_cells), nnz, start = _mtx_header(path)
+    end = os.path.getsize(path)
+    n_jobs = _max_workers(n_jobs)
+    # A parsed chunk takes roughly 10 times its size in memory
+    chunk_bytes = min(chunk_bytes, max(1 << 20, _memory_budget(chunk_bytes * 10 * n_jobs, 0.5)
+                                       // (10 * n_jobs)))
+    offsets = _line_offsets(path, start, end, max(1, (end - start) // chunk_bytes, n_jobs))
+    tasks = ((path, a, b, field == 'pattern') for a, b in zip(offsets[:-1], offsets[1:]))
+    # The entries are copied into buffers preallocated from the header
+    gene_idx = np.empty(nnz, np.int32)
+    cell_idx = np.empty(nnz, np.int32)
+    values = np.empty(nnz, np.float32)
+    pos = 0
+    with _stage('parse'):
+        for rows, cols, vals in _parallel_map(_parse_mtx_chunk, tasks, n_jobs, 'processes'):
+            gene_idx[pos:pos + len(rows)] = rows
+            cell_idx[pos:pos + len(rows)] = cols
+            values[pos:pos + len(rows)] = vals
+            pos += len(rows)
+    if pos != nnz:
+        raise ValueError('%s: expected %d entries, found %d' % (path, nnz, pos))
+    with _stage('to_csr'):
+        X = sp.csr_matrix((values, (cell_idx, gene_idx)), shape=(n_cells, n_genes))
+        del gene_idx, cell_idx, values
+
+    obs_names = _read_table_column(barcodes) if barcodes else np.arange(n_cells).astype(str)
+    var = pd.DataFrame(index=np.arange(n_genes).astype(str))
+    if genes:
+        gene_ids = _read_table_column(genes, 0)
+        symbols = _read_table_column(genes, 1)
+        names = symbols if var_names == 'gene_symbols' else gene_ids
+        var = pd.DataFrame({'gene_ids': gene_ids}, index=ad.utils.make_index_unique(pd.Index(names)))
+    adata = ad.AnnData(X=X, obs=pd.DataFrame(index=obs_names), var=var)
+    if cache:
+        with _stage('write_cache'):
+            _save_npz_counts(cache_path, adata)
+    return adata
+
+@_profiled
+def read_tsv(path, cache = True, genes_as_rows = True, chunksize = 2000, cache_dir = None):
+    '''Reads a dense tab-separated count table (a header row of cell names
+    and a first column of gene names) into a cells x genes AnnData object
+    with a CSR matrix. The table is read in chunks of rows that are converted
+    to sparse right away, so the dense table is never held in memory.
+    
+    Input:
+    path : the .tsv file
+    cache : write the matrix to a .npz file and load it from there while
+            it is newer than the input. The file name is path plus a hash
+            of genes_as_rows.
+    genes_as_rows : whether the rows of the table are genes (and the
+                    columns cells), otherwise the rows are cells
+    chunksize : number of rows parsed at a time
+    cache_dir : directory of the cache file, the folder of path by default
+    
+    Output:
+    AnnData object (float32 counts)
+    '''
+    cache_path = _npz_cache_path(path, cache_dir, {'genes_as_rows': bool(genes_as_rows)})
+    if cache and _cache_valid(cache_path, [path]):
+        with _stage('load_cache'):
+            return _load_npz_counts(cache_path)
+    blocks, row_names = [], []
+    with _stage('parse'):
+        # The header is read on its own, so a table without rows still gives
+        # its column names
+        columns = pd.read_csv(path, sep='\t', index_col=0, nrows=0).columns.values.astype(str)
+        for chunk in pd.read_csv(path, sep='\t', index_col=0, chunksize=chunksize):
+            row_names.append(chunk.index.values.astype(str))
+            blocks.append(sp.csr_matrix(chunk.values.astype(np.float32)))
+    if blocks:
+        X = sp.vstack(blocks, format='csr')
+        row_names = np.concatenate(row_names)
+    else:
+        X = sp.csr_matrix((0, len(columns)), dtype=np.float32)
+        row_names = np.array([], dtype=str)
+    if genes_as_rows:
+        X = X.T.tocsr()
+        obs_names, var_names = columns, row_names
+    else:
+        obs_names, var_names = row_names, columns
+    adata = ad.AnnData(X=X, obs=pd.DataFrame(index=obs_names),
+                       var=pd.DataFrame(index=ad.utils.make_index_unique(pd.Index(var_names))))
+    if cache:
+        with _stage('write_cache'):
+            _save_npz_counts(cache_path, adata)
+    return adata